@@ -0,0 +1,49 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import unittest
+
+THRESHOLDS = os.path.join(os.path.dirname(__file__), 'thresholds.json')
+
+# Metrics measured so far in this run, keyed by scenario
+_report = {}
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """Check measured metrics against the limits in thresholds.json.
+
+    Set BENCHMARK_REPORT to a path to also get the metrics measured by all
+    of the benchmarks run as JSON.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with open(THRESHOLDS) as f:
+            cls.thresholds = json.load(f)
+
+    @classmethod
+    def tearDownClass(cls):
+        path = os.environ.get('BENCHMARK_REPORT')
+        if path:
+            with open(path, 'w') as f:
+                json.dump(_report, f, indent=4, sort_keys=True)
+
+    def check(self, name, metrics):
+        _report[name] = metrics
+        for metric, limit in sorted(self.thresholds[name].items()):
+            self.assertLessEqual(
+                metrics.get(metric, 0), limit,
+                '{}: {} regressed'.format(name, metric))
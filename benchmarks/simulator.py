@@ -0,0 +1,283 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory stand-in for the Juju relation data and hook tools.
+
+The Model keeps the relation data of a single local unit, counts every
+simulated hook tool call and drives the interface endpoints through hooks
+with the startup code of the reactive framework, so that the relation data
+and unitdata reads the framework makes in every hook are accounted for.
+"""
+
+import collections
+import contextlib
+import json
+import tracemalloc
+from unittest import mock
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+import charmhelpers.contrib.network.ip as ch_net_ip
+from charms import reactive
+
+
+class FakeKV(object):
+    """unitdata.Storage replacement that keeps data in memory.
+
+    Values are serialized as JSON, like the real SQLite backed store, so
+    that mutating a loaded value has no effect until it is set again.
+    Strings, such as the hashes the framework keeps for every received
+    key, are immutable and kept as they are.
+    """
+
+    def __init__(self, calls):
+        self._data = {}
+        self._calls = calls
+
+    def get(self, key, default=None):
+        self._calls['kv-get'] += 1
+        if key not in self._data:
+            return default
+        serialized, value = self._data[key]
+        return json.loads(value) if serialized else value
+
+    def set(self, key, value):
+        self._calls['kv-set'] += 1
+        if isinstance(value, str):
+            self._data[key] = (False, value)
+        else:
+            self._data[key] = (True, json.dumps(value))
+
+    def update(self, mapping, prefix=''):
+        for key, value in mapping.items():
+            self.set(prefix + key, value)
+
+    def unset(self, key):
+        self._calls['kv-set'] += 1
+        self._data.pop(key, None)
+
+    def flush(self, save=True):
+        pass
+
+
+class Model(object):
+    """Relation data and hook context seen by a single local unit.
+
+    Set trace_every to trace the memory allocated by every n-th hook, the
+    highest peak seen is kept in peak_memory. Tracing every hook would slow
+    the larger scenarios down by an order of magnitude.
+    """
+
+    def __init__(self, local_unit, endpoint_name, address='10.0.0.1'):
+        self.local_unit = local_unit
+        self.endpoint_name = endpoint_name
+        self.address = address
+        self.calls = collections.Counter()
+        self.kv = FakeKV(self.calls)
+        self.flags = set()
+        # relation id -> remote unit name -> data
+        self.remote = collections.OrderedDict()
+        # relation id -> data published by the local unit
+        self.local = {}
+        # Endpoint instances of the running hook, keyed by endpoint name
+        self._endpoints = {}
+        self._hook = ('install', None, None)
+        self._atexit = []
+        self._next_relation = 0
+        self.trace_every = None
+        self.peak_memory = 0
+
+    # Hook tools
+
+    def relation_get(self, attribute=None, unit=None, rid=None, app=None):
+        self.calls['relation-get'] += 1
+        if unit == self.local_unit:
+            data = self.local.get(rid, {})
+        else:
+            data = self.remote.get(rid, {}).get(unit, {})
+        if attribute:
+            return data.get(attribute)
+        return dict(data)
+
+    def relation_set(self, relation_id=None, relation_settings=None,
+                     **kwargs):
+        self.calls['relation-set'] += 1
+        settings = dict(relation_settings or {}, **kwargs)
+        data = self.local.setdefault(relation_id, {})
+        for key, value in settings.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            else:
+                data[key] = str(value)
+
+    def related_units(self, relid=None):
+        self.calls['relation-list'] += 1
+        return list(self.remote.get(relid or self._hook[1], {}))
+
+    def relation_ids(self, reltype=None):
+        self.calls['relation-ids'] += 1
+        return list(self.remote)
+
+    def network_get(self, *args, **kwargs):
+        self.calls['network-get'] += 1
+        return self.address
+
+    # Hook context
+
+    def hook_name(self):
+        return self._hook[0]
+
+    def relation_id(self):
+        return self._hook[1]
+
+    def remote_unit(self):
+        return self._hook[2]
+
+    def atexit(self, callback, *args, **kwargs):
+        self._atexit.append((callback, args, kwargs))
+
+    def set_flag(self, flag, value=None):
+        self.flags.add(flag)
+
+    def clear_flag(self, flag):
+        self.flags.discard(flag)
+
+    def toggle_flag(self, flag, should_set):
+        if should_set:
+            self.set_flag(flag)
+        else:
+            self.clear_flag(flag)
+
+    def is_flag_set(self, flag):
+        return flag in self.flags
+
+    def all_flags_set(self, *flags):
+        return all(flag in self.flags for flag in flags)
+
+    def get_flags(self):
+        return sorted(self.flags)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Wire the hook tools, unitdata and flags up to this model."""
+        patches = [
+            mock.patch.object(hookenv, 'relation_get', self.relation_get),
+            mock.patch.object(hookenv, 'relation_set', self.relation_set),
+            mock.patch.object(hookenv, 'related_units', self.related_units),
+            mock.patch.object(hookenv, 'relation_ids', self.relation_ids),
+            mock.patch.object(hookenv, 'hook_name', self.hook_name),
+            mock.patch.object(hookenv, 'relation_id', self.relation_id),
+            mock.patch.object(hookenv, 'remote_unit', self.remote_unit),
+            mock.patch.object(hookenv, 'local_unit',
+                              lambda: self.local_unit),
+            mock.patch.object(hookenv, 'log', lambda *args, **kwargs: None),
+            mock.patch.object(hookenv, 'atexit', self.atexit),
+            mock.patch.object(hookenv, 'network_get_primary_address',
+                              self.network_get),
+            mock.patch.object(ch_net_ip, 'get_relation_ip', self.network_get),
+            mock.patch.object(unitdata, 'kv', lambda: self.kv),
+        ]
+        for name in ('set_flag', 'clear_flag', 'toggle_flag', 'is_flag_set',
+                     'all_flags_set', 'get_flags'):
+            patches.append(
+                mock.patch.object(reactive, name, getattr(self, name)))
+        # The flag functions the framework startup code imported, its
+        # data_changed() is left as is and uses the unitdata of the model
+        for name in ('set_flag', 'clear_flag', 'toggle_flag', 'is_flag_set'):
+            patches.append(mock.patch.object(
+                reactive.endpoints, name, getattr(self, name)))
+        patches.append(mock.patch.object(
+            reactive.endpoints.Endpoint, '_endpoints', self._endpoints))
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            yield self
+
+    # Model changes, each one runs the hook Juju would run for it
+
+    def add_relation(self):
+        relation_id = '{}:{}'.format(
+            self.endpoint_name, self._next_relation)
+        self._next_relation += 1
+        self.remote[relation_id] = collections.OrderedDict()
+        return relation_id
+
+    def join(self, relation_id, unit_name, hook):
+        self.remote[relation_id][unit_name] = {}
+        self.run_hook('relation-joined', hook, relation_id, unit_name)
+
+    def change(self, relation_id, unit_name, data, hook):
+        self.remote[relation_id][unit_name].update(data)
+        self.run_hook('relation-changed', hook, relation_id, unit_name)
+
+    def depart(self, relation_id, unit_name, hook):
+        del self.remote[relation_id][unit_name]
+        self.run_hook('relation-departed', hook, relation_id, unit_name)
+        if not self.remote[relation_id]:
+            del self.remote[relation_id]
+            self.run_hook('relation-broken', hook, relation_id, None)
+
+    def run_hook(self, kind, hook, relation_id=None, unit_name=None):
+        """Run a hook for the endpoint.
+
+        hook(model) is called to build the endpoint with endpoint() and run
+        the handlers. The callbacks registered with hookenv.atexit(), which
+        flush the data published on the relations, are run at the end.
+        """
+        self._hook = ('{}-{}'.format(self.endpoint_name, kind),
+                      relation_id, unit_name)
+        trace = False
+        if self.trace_every:
+            trace = self.calls['hooks'] % self.trace_every == 0
+        self.calls['hooks'] += 1
+        if trace:
+            tracemalloc.start()
+        endpoint = hook(self)
+        # Last registered first, as hookenv._run_atexit() does
+        while self._atexit:
+            callback, args, kwargs = self._atexit.pop()
+            callback(*args, **kwargs)
+        if trace:
+            self.peak_memory = max(
+                self.peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        self._endpoints.clear()
+        self._hook = ('update-status', None, None)
+        return endpoint
+
+    def endpoint(self, endpoint_class):
+        """Build the endpoint as the reactive framework does in each hook.
+
+        This runs the same steps as Endpoint._startup(), including the read
+        of the data of every joined unit to manage the automatic flags.
+        """
+        endpoint = endpoint_class(self.endpoint_name, list(self.remote))
+        self._endpoints[self.endpoint_name] = endpoint
+        endpoint.register_triggers()
+        endpoint._manage_departed()
+        endpoint._manage_flags()
+        for relation in endpoint.relations:
+            hookenv.atexit(relation._flush_data)
+        return endpoint
+
+    def run_handlers(self, endpoint):
+        """Run the endpoint handlers whose automatic flag is set.
+
+        The framework never sets the broken flag, so the broken handler of
+        the provides side is not run.
+        """
+        for name in ('joined', 'changed', 'departed'):
+            flag = 'endpoint.{}.{}'.format(self.endpoint_name, name)
+            if flag in self.flags:
+                getattr(endpoint, name)()
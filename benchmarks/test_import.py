@@ -0,0 +1,80 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import time benchmark for the provides and requires modules.
+
+Every hook imports both modules, so their import time adds to the latency
+of every hook, including the ones where the endpoints have nothing to do.
+
+charmhelpers is mocked out, like in the scale benchmarks, so the time
+budget only covers the interface's own imports, not the cost of importing
+charmhelpers or its dependencies such as netaddr and netifaces. In a hook,
+the reactive framework has already imported charmhelpers.core by then. The
+modules that only a few hooks need are checked separately, by failing the
+import of any of DEFERRED_MODULES, mocked or not.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks import base
+
+# Modules that the interface must only import when they are actually used
+DEFERRED_MODULES = ('charmhelpers.contrib.network.ip',)
+
+RUNS = 5
+
+# Run in a fresh interpreter, the framework and the mocked charmhelpers are
+# imported before the timing starts as they are already loaded by the time a
+# hook imports the interface.
+IMPORT_SCRIPT = '''
+import json
+import sys
+import time
+
+import benchmarks
+from charms import reactive  # noqa
+
+for name in {deferred!r}:
+    # Importing a module mapped to None fails
+    sys.modules[name] = None
+start = time.perf_counter()
+try:
+    import provides  # noqa
+    import requires  # noqa
+except ImportError as e:
+    sys.exit('Deferred module imported at module import time: {{}}'.format(e))
+print(json.dumps({{'import-time-ms': (time.perf_counter() - start) * 1000}}))
+'''
+
+
+def measure_import():
+    script = IMPORT_SCRIPT.format(deferred=DEFERRED_MODULES)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', script], cwd=root, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return json.loads(result.stdout)
+
+
+class TestImport(base.BenchmarkTestCase):
+
+    def test_import(self):
+        # The fastest run is the least disturbed by the rest of the system
+        runs = [measure_import()['import-time-ms'] for _ in range(RUNS)]
+        self.check('import', {'import-time-ms': round(min(runs), 3)})
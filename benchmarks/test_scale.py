@@ -0,0 +1,258 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scale benchmarks for the provides and requires endpoints.
+
+Each scenario drives an endpoint through a storm of relation hooks against
+the in-memory model and fails when one of its metrics goes over the limit
+recorded in thresholds.json.
+"""
+
+import collections
+import copy
+import time
+
+import provides
+import requires
+from benchmarks import base
+from benchmarks import simulator
+
+ENDPOINT_NAME = 'shared-db'
+DB_HOST = '10.0.0.10'
+
+# 20 consumer applications of 10 units each, every unit requests a database
+# under each prefix, for 200 units and 10 prefixes in total. The framework
+# reads every joined unit in each hook, so the cost of a storm grows with the
+# square of the number of units.
+RELATIONS = 20
+UNITS_PER_RELATION = 10
+PREFIXES = tuple('db{}'.format(i) for i in range(10))
+
+# Units of the database application seen by a single consumer unit
+DB_UNITS = 3
+CONSUMER_UNITS = RELATIONS * UNITS_PER_RELATION
+
+# Trace the memory allocated by every n-th hook of a storm
+TRACE_EVERY = 10
+
+
+def unit_request(unit_name, hostname):
+    data = {}
+    for prefix in PREFIXES:
+        data['{}_database'.format(prefix)] = prefix
+        data['{}_username'.format(prefix)] = prefix
+        data['{}_hostname'.format(prefix)] = hostname
+    return data
+
+
+def provides_hook(model):
+    """Handlers of a database charm servicing the requests it gets."""
+    endpoint = model.endpoint(provides.MySQLSharedProvides)
+    model.run_handlers(endpoint)
+    pending = endpoint.pending_requests()
+    if pending:
+        allowed_units = collections.defaultdict(list)
+        for request in endpoint.requests():
+            allowed_units[(request.relation_id, request.prefix)].append(
+                request.unit)
+        for relation_id, prefix in sorted({(request.relation_id,
+                                            request.prefix)
+                                           for request in pending}):
+            endpoint.set_db_connection_info(
+                relation_id, DB_HOST, 'pw-{}'.format(prefix),
+                allowed_units=' '.join(
+                    allowed_units[(relation_id, prefix)]),
+                prefix=prefix)
+    return endpoint
+
+
+def requires_hook(model):
+    """Handlers of a consumer charm configuring and reading its databases."""
+    endpoint = model.endpoint(requires.MySQLSharedRequires)
+    model.run_handlers(endpoint)
+    if '{}.connected'.format(ENDPOINT_NAME) in model.flags:
+        endpoint.configure_many(
+            [(prefix, prefix, prefix) for prefix in PREFIXES])
+    if '{}.available'.format(ENDPOINT_NAME) in model.flags:
+        endpoint.db_host()
+        for prefix in PREFIXES:
+            endpoint.password(prefix)
+    return endpoint
+
+
+def provides_model():
+    return simulator.Model('mysql/0', ENDPOINT_NAME)
+
+
+def consumer_units(relation_index):
+    return ['app{}/{}'.format(relation_index, unit)
+            for unit in range(UNITS_PER_RELATION)]
+
+
+def provides_join_storm(model):
+    for index in range(RELATIONS):
+        relation_id = model.add_relation()
+        for unit_name in consumer_units(index):
+            model.join(relation_id, unit_name, provides_hook)
+            model.change(relation_id, unit_name,
+                         unit_request(unit_name, '10.1.0.1'), provides_hook)
+
+
+def provides_change_storm(model):
+    for index, relation_id in enumerate(list(model.remote)):
+        for unit_name in consumer_units(index):
+            model.change(relation_id, unit_name,
+                         unit_request(unit_name, '10.2.0.1'), provides_hook)
+
+
+def provides_depart_storm(model):
+    for index, relation_id in enumerate(list(model.remote)):
+        for unit_name in consumer_units(index):
+            model.depart(relation_id, unit_name, provides_hook)
+
+
+def requires_model():
+    return simulator.Model('app0/0', ENDPOINT_NAME)
+
+
+def db_units():
+    return ['mysql/{}'.format(unit) for unit in range(DB_UNITS)]
+
+
+def db_data(allowed_units):
+    data = {'db_host': DB_HOST, 'db_port': '3306'}
+    for prefix in PREFIXES:
+        data['{}_password'.format(prefix)] = 'pw-{}'.format(prefix)
+        data['{}_allowed_units'.format(prefix)] = ' '.join(allowed_units)
+    return data
+
+
+def requires_join_storm(model):
+    relation_id = model.add_relation()
+    for unit_name in db_units():
+        model.join(relation_id, unit_name, requires_hook)
+        model.change(relation_id, unit_name, db_data([model.local_unit]),
+                     requires_hook)
+
+
+def requires_change_storm(model):
+    # Every consumer unit added to the grants fires -changed on this unit
+    relation_id = list(model.remote)[0]
+    allowed_units = [model.local_unit]
+    for unit in range(1, CONSUMER_UNITS):
+        allowed_units.append('app{}/{}'.format(
+            unit // UNITS_PER_RELATION, unit % UNITS_PER_RELATION))
+        model.change(relation_id, db_units()[0], db_data(allowed_units),
+                     requires_hook)
+
+
+def requires_depart_storm(model):
+    relation_id = list(model.remote)[0]
+    for unit_name in db_units():
+        model.depart(relation_id, unit_name, requires_hook)
+
+
+# name: (model factory, setup, storm)
+SCENARIOS = collections.OrderedDict([
+    ('provides-join', (provides_model, None, provides_join_storm)),
+    ('provides-change', (
+        provides_model, provides_join_storm, provides_change_storm)),
+    ('provides-depart', (
+        provides_model, provides_join_storm, provides_depart_storm)),
+    ('requires-join', (requires_model, None, requires_join_storm)),
+    ('requires-change', (
+        requires_model, requires_join_storm, requires_change_storm)),
+    ('requires-depart', (
+        requires_model, requires_join_storm, requires_depart_storm)),
+])
+
+
+# Models left behind by the setup of scenarios, keyed by setup function
+_prepared = {}
+
+
+def prepare(model_factory, setup):
+    if setup not in _prepared:
+        model = model_factory()
+        with model.installed():
+            setup(model)
+        _prepared[setup] = model
+    return copy.deepcopy(_prepared[setup])
+
+
+def run_scenario(name, trace_every=None):
+    """Run a scenario and return the metrics of its storm.
+
+    The wall time is only reported, not checked, as it depends on the
+    machine running the benchmarks. It includes the time spent tracing the
+    memory of the sampled hooks.
+    """
+    model_factory, setup, storm = SCENARIOS[name]
+    model = prepare(model_factory, setup) if setup else model_factory()
+    model.calls.clear()
+    model.trace_every = trace_every
+    with model.installed():
+        start = time.perf_counter()
+        storm(model)
+        elapsed = time.perf_counter() - start
+    metrics = dict(model.calls)
+    metrics['wall-time'] = round(elapsed, 3)
+    if trace_every:
+        metrics['peak-hook-memory-kib'] = model.peak_memory // 1024
+    return model, metrics
+
+
+class TestScale(base.BenchmarkTestCase):
+
+    def measure(self, name):
+        model, metrics = run_scenario(name, trace_every=TRACE_EVERY)
+        self.check(name, metrics)
+        return model
+
+    def test_provides_join(self):
+        model = self.measure('provides-join')
+        self.assertEqual(len(model.local), RELATIONS)
+        for index, relation_id in enumerate(model.remote):
+            data = model.local[relation_id]
+            self.assertEqual(data['db_host'], DB_HOST)
+            self.assertEqual(data['ingress-address'], model.address)
+            for prefix in PREFIXES:
+                self.assertEqual(
+                    data['{}_allowed_units'.format(prefix)],
+                    ' '.join(consumer_units(index)))
+
+    def test_provides_change(self):
+        model = self.measure('provides-change')
+        self.assertEqual(len(model.remote), RELATIONS)
+
+    def test_provides_depart(self):
+        model = self.measure('provides-depart')
+        self.assertEqual(model.remote, {})
+        self.assertEqual(model.kv.get('shared-db.requests-index'), {})
+
+    def test_requires_join(self):
+        model = self.measure('requires-join')
+        self.assertIn('shared-db.available', model.flags)
+        data = list(model.local.values())[0]
+        for prefix in PREFIXES:
+            self.assertEqual(data['{}_database'.format(prefix)], prefix)
+
+    def test_requires_change(self):
+        model = self.measure('requires-change')
+        self.assertIn('shared-db.available', model.flags)
+
+    def test_requires_depart(self):
+        model = self.measure('requires-depart')
+        self.assertNotIn('shared-db.available', model.flags)
+        self.assertNotIn('shared-db.connected', model.flags)
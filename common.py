@@ -0,0 +1,37 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Constants shared by both sides of the interface.
+
+The keys and versions of the protocol must be the same on both sides, so
+they are only defined here.
+"""
+
+# Hooks in which the address of a binding may have changed. Addresses cached
+# in unitdata are only resolved again when one of them runs.
+ADDRESS_REFRESH_HOOKS = (
+    'install', 'upgrade-charm', 'config-changed', 'post-series-upgrade')
+
+# Version 2 of the protocol publishes the credentials of all prefixes in the
+# single JSON encoded CREDENTIALS_KEY instead of one raw key per field and
+# prefix. The provider uses it on a relation when all of the units
+# requesting databases on it advertise support for it in PROTOCOL_VERSION_KEY.
+PROTOCOL_VERSION = 2
+PROTOCOL_VERSION_KEY = 'protocol-version'
+CREDENTIALS_KEY = 'credentials'
+
+# JSON encoded number of connections each unit of a relation is granted,
+# keyed by prefix
+GRANTED_CONNECTIONS_KEY = 'granted-connections'
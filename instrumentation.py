@@ -0,0 +1,221 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in instrumentation of the hooks run by the endpoints.
+
+Set MYSQL_SHARED_HOOK_STATS in the environment of the hooks to account for
+the hook tool calls. A value of 'log' emits the summary of each hook as a
+JSON log line, any other value is the path of a file the summary is appended
+to as a line of JSON.
+
+Set MYSQL_SHARED_PROFILE_DIR to the path of a directory to profile the
+endpoint handlers. A dump is written there for each handler run, and only
+the most recent MYSQL_SHARED_PROFILE_KEEP dumps, 100 by default, are kept.
+"""
+
+import collections
+import contextlib
+import functools
+import importlib
+import json
+import os
+import threading
+import time
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+ENV_VAR = 'MYSQL_SHARED_HOOK_STATS'
+PROFILE_DIR_ENV_VAR = 'MYSQL_SHARED_PROFILE_DIR'
+PROFILE_KEEP_ENV_VAR = 'MYSQL_SHARED_PROFILE_KEEP'
+PROFILE_KEEP = 100
+
+# Hook tools accounted for, as (module, function, kind). Modules are named
+# rather than imported, so that they are only loaded when accounting is on.
+HOOK_TOOLS = (
+    ('charmhelpers.core.hookenv', 'relation_get', 'relation-get'),
+    ('charmhelpers.core.hookenv', 'relation_set', 'relation-set'),
+    ('charmhelpers.core.hookenv', 'related_units', 'relation-list'),
+    ('charmhelpers.core.hookenv', 'network_get', 'network-get'),
+    ('charmhelpers.core.hookenv', 'network_get_primary_address',
+     'network-get'),
+    ('charmhelpers.contrib.network.ip', 'get_relation_ip', 'network-get'),
+)
+
+# unitdata.Storage methods accounted for, as (method, kind)
+KV_METHODS = (
+    ('get', 'kv-get'),
+    ('getrange', 'kv-get'),
+    ('set', 'kv-set'),
+    ('update', 'kv-set'),
+    ('unset', 'kv-set'),
+    ('unsetrange', 'kv-set'),
+)
+
+_stats = None
+_profiling = False
+
+
+class HookStats(object):
+    """Count and time the hook tool calls of the running hook."""
+
+    def __init__(self, target):
+        self.target = target
+        self.started = time.time()
+        self.endpoints = set()
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self._start = time.monotonic()
+        # Hook tools may be called from several threads, see
+        # MySQLSharedProvides.prefetch_received()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, kind, func):
+        """Return func accounting its calls under kind.
+
+        Nested calls of the same kind, such as get_relation_ip() calling
+        network_get_primary_address(), are accounted for once.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            active = self._local.__dict__.setdefault('active', set())
+            if kind in active:
+                return func(*args, **kwargs)
+            active.add(kind)
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.times[kind] += time.monotonic() - start
+                    self.counts[kind] += 1
+                active.discard(kind)
+        return wrapper
+
+    def install(self):
+        for module_name, name, kind in HOOK_TOOLS:
+            module = importlib.import_module(module_name)
+            setattr(module, name, self.wrap(kind, getattr(module, name)))
+        kv = unitdata.kv()
+        for name, kind in KV_METHODS:
+            setattr(kv, name, self.wrap(kind, getattr(kv, name)))
+
+    def summary(self):
+        """Return the summary record of the hook so far.
+
+        :rtype: Dict[str, Any]
+        """
+        return {
+            'hook': hookenv.hook_name(),
+            'unit': hookenv.local_unit(),
+            'endpoints': sorted(self.endpoints),
+            'started': round(self.started, 3),
+            'duration': round(time.monotonic() - self._start, 6),
+            'tool-time': round(sum(self.times.values()), 6),
+            'calls': {
+                kind: {'count': count, 'time': round(self.times[kind], 6)}
+                for kind, count in self.counts.items()},
+        }
+
+    def emit(self):
+        """Log the summary, or append it to the target file."""
+        record = json.dumps(self.summary(), sort_keys=True)
+        if self.target == 'log':
+            hookenv.log(record, level=hookenv.DEBUG)
+            return
+        try:
+            with open(self.target, 'a') as f:
+                f.write(record + '\n')
+        except OSError as e:
+            hookenv.log('Unable to write hook stats to {}: {}'.format(
+                self.target, e), level=hookenv.WARNING)
+
+
+def install(endpoint_name):
+    """Start accounting for the hook tool calls if enabled.
+
+    The hook tools are wrapped once per hook, by the first endpoint that
+    asks for it, and the summary is emitted at the end of the hook, after
+    the relation data has been flushed.
+
+    :param endpoint_name: Name of the endpoint asking for accounting.
+    :type endpoint_name: str
+    :returns: The accounting of the running hook, None when disabled.
+    :rtype: Optional[HookStats]
+    """
+    global _stats
+    target = os.environ.get(ENV_VAR)
+    if not target:
+        return None
+    if _stats is None:
+        _stats = HookStats(target)
+        _stats.install()
+        # Callbacks run in reverse order, so registering before the
+        # endpoints register their data flushes makes this run after them.
+        hookenv.atexit(_stats.emit)
+    _stats.endpoints.add(endpoint_name)
+    return _stats
+
+
+@contextlib.contextmanager
+def profiled(endpoint_name, handler):
+    """Profile the body of an endpoint handler if enabled.
+
+    Handlers called from another profiled handler are part of the dump of
+    the outer one.
+
+    :param endpoint_name: Name of the endpoint running the handler.
+    :type endpoint_name: str
+    :param handler: Name of the handler.
+    :type handler: str
+    """
+    global _profiling
+    directory = os.environ.get(PROFILE_DIR_ENV_VAR)
+    if not directory or _profiling:
+        yield
+        return
+    # Only loaded when profiling, as every hook imports this module
+    import cProfile
+    profiler = cProfile.Profile()
+    _profiling = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling = False
+        _dump_profile(profiler, directory, '{}-{}.{}'.format(
+            hookenv.hook_name(), endpoint_name, handler))
+
+
+def _dump_profile(profiler, directory, name):
+    """Write a profile dump and rotate out the oldest ones.
+
+    Dump names start with the time they were taken at, so that sorting
+    them by name sorts them by age.
+    """
+    try:
+        keep = int(os.environ.get(PROFILE_KEEP_ENV_VAR) or PROFILE_KEEP)
+        os.makedirs(directory, exist_ok=True)
+        # In microseconds, time.time_ns() needs Python 3.7
+        profiler.dump_stats(os.path.join(directory, '{:020d}-{}.prof'.format(
+            int(time.time() * 1e6), name)))
+        dumps = sorted(dump for dump in os.listdir(directory)
+                       if dump.endswith('.prof'))
+        for dump in dumps[:max(len(dumps) - keep, 0)]:
+            os.remove(os.path.join(directory, dump))
+    except (OSError, ValueError) as e:
+        hookenv.log('Unable to write profile to {}: {}'.format(
+            directory, e), level=hookenv.WARNING)
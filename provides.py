@@ -12,57 +12,590 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import collections
+import hashlib
+import json
+import os
+
 from charms import reactive
-import charmhelpers.contrib.network.ip as ch_net_ip
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+try:
+    from . import common
+    from . import instrumentation
+except ImportError:
+    # Imported as top level modules, as in the unit tests
+    import common
+    import instrumentation
+
+# Fields a consumer sets, optionally prefixed, to request a database. The
+# connections field is the optional number of connections the unit asks for.
+REQUEST_FIELDS = ('database', 'username', 'hostname', 'connections')
+
+# Set to a number of threads to prefetch the data of the remote units
+# concurrently, see MySQLSharedProvides.prefetch_received()
+PREFETCH_WORKERS_ENV_VAR = 'MYSQL_SHARED_PREFETCH_WORKERS'
+
+# Shared keys that can be overridden for a single prefix, published as
+# <prefix>_<key>
+PREFIX_OVERRIDES = ('db_host', 'db_port', 'db_ro_hosts')
+
+# Default of the optional shared keys that are left as published when the
+# caller does not pass them, None withdraws them
+_UNCHANGED = object()
+
+SharedDBRequest = collections.namedtuple(
+    'SharedDBRequest',
+    ['relation_id', 'unit', 'prefix', 'database', 'username', 'hostname'])
+SharedDBRequest.__doc__ = """A database request made by a remote unit.
+
+The prefix is None for the unprefixed request.
+"""
+
+
+def unit_requests(received):
+    """Extract the database requests made by a remote unit.
+
+    :param received: Data received from the remote unit.
+    :type received: Mapping[str, Any]
+    :returns: Requested fields keyed by prefix, '' for the unprefixed
+              request. Only requests with a username are returned.
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    requests = {}
+    for key, value in received.items():
+        for field in REQUEST_FIELDS:
+            if key == field:
+                prefix = ''
+            elif key.endswith('_' + field):
+                prefix = key[:-len(field) - 1]
+            else:
+                continue
+            requests.setdefault(prefix, {})[field] = value
+            break
+    return {prefix: fields for prefix, fields in requests.items()
+            if fields.get('username')}
+
+
+def unit_protocol_version(received):
+    """Return the protocol version advertised by a remote unit.
+
+    :param received: Data received from the remote unit.
+    :type received: Mapping[str, Any]
+    :returns: The advertised version, 1 for units that predate versioning.
+    :rtype: int
+    """
+    try:
+        return int(received.get(common.PROTOCOL_VERSION_KEY) or 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def format_hosts(hosts):
+    """Return the relation value of a list of addresses.
+
+    :param hosts: Addresses, or their space separated string form.
+    :type hosts: Optional[Union[str, Iterable[str]]]
+    :returns: Space separated addresses, None when there are none.
+    :rtype: Optional[str]
+    """
+    if hosts is None or isinstance(hosts, str):
+        return hosts or None
+    return ' '.join(hosts) or None
+
+
+def format_endpoints(endpoints):
+    """Return the relation value of a weighted list of equivalent endpoints.
+
+    :param endpoints: Addresses in order of preference, each optionally
+                      given as an (address, weight) tuple. The weight
+                      defaults to 1, a weight of 0 drains the endpoint.
+    :type endpoints: Optional[Iterable[Union[str, Tuple[str, float]]]]
+    :returns: JSON encoded list of {'host': ..., 'weight': ...}, None when
+              there are no endpoints.
+    :rtype: Optional[str]
+    """
+    records = []
+    for endpoint in endpoints or ():
+        host, weight = (
+            (endpoint, 1) if isinstance(endpoint, str) else endpoint)
+        if weight < 0:
+            raise ValueError('Negative weight for {}'.format(host))
+        records.append({'host': host, 'weight': weight})
+    return json.dumps(records) if records else None
 
 
 class MySQLSharedProvides(reactive.Endpoint):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.ingress_address = ch_net_ip.get_relation_ip(self.endpoint_name)
+        instrumentation.install(self.endpoint_name)
+        self._ingress_address = None
+        self._requests_index = None
+        self._requests = None
+        self._fingerprints = None
+        self._serviced = None
+        self._serviced_dirty = False
+        self._protocol_versions = None
 
     def relation_ids(self):
         return [x.relation_id for x in self.relations]
 
+    @property
+    def ingress_address(self):
+        """Address of the endpoint's binding.
+
+        Resolved lazily and cached in unitdata per binding, so that most
+        hooks do not need a network-get call at all.
+        """
+        if self._ingress_address is None:
+            key = self.expand_name('{endpoint_name}.ingress-address')
+            address = None
+            if hookenv.hook_name() not in common.ADDRESS_REFRESH_HOOKS:
+                address = unitdata.kv().get(key)
+            if not address:
+                # Imported here as the module, and the modules it imports,
+                # are only needed in the few hooks that resolve the address
+                import charmhelpers.contrib.network.ip as ch_net_ip
+                address = ch_net_ip.get_relation_ip(self.endpoint_name)
+                unitdata.kv().set(key, address)
+            self._ingress_address = address
+        return self._ingress_address
+
+    @ingress_address.setter
+    def ingress_address(self, address):
+        self._ingress_address = address
+
     def set_ingress_address(self):
+        """Publish the ingress address on the relations that need it.
+
+        The address published on each relation is remembered, so relations
+        that already carry the current address are skipped without touching
+        their data. Only new relations, or all of them when the address
+        changed, are written to.
+
+        :returns: Number of relation keys that actually changed.
+        :rtype: int
+        """
+        key = self.expand_name('{endpoint_name}.published-address')
+        published = unitdata.kv().get(key) or {}
+        relation_ids = set()
+        changed = 0
         for relation in self.relations:
-            relation.to_publish_raw["ingress-address"] = self.ingress_address
-            relation.to_publish_raw["private-address"] = self.ingress_address
+            relation_ids.add(relation.relation_id)
+            if published.get(relation.relation_id) == self.ingress_address:
+                continue
+            changed += self._publish(
+                relation, "ingress-address", self.ingress_address)
+            changed += self._publish(
+                relation, "private-address", self.ingress_address)
+            published[relation.relation_id] = self.ingress_address
+        # Forget about relations that are gone
+        published = {relation_id: address
+                     for relation_id, address in published.items()
+                     if relation_id in relation_ids}
+        if published != unitdata.kv().get(key):
+            unitdata.kv().set(key, published)
+        return changed
+
+    def register_triggers(self):
+        super().register_triggers()
+        # The framework reads the data of every joined unit, one after the
+        # other, to manage the changed flags of relation hooks of this
+        # endpoint, right after this is called.
+        if hookenv.hook_name().startswith(self.endpoint_name + '-relation-'):
+            self.prefetch_received()
+
+    def prefetch_received(self, max_workers=None):
+        """Load the data received from all joined units concurrently.
+
+        The first read of each unit's received data runs relation-get, and
+        runs them one after the other. Loading them through a bounded pool
+        of threads up front means that later reads come from memory. This
+        runs at the start of the relation hooks of the endpoint, before the
+        framework reads the data to manage the changed flags.
+
+        :param max_workers: Number of threads, defaults to the value of
+                            MYSQL_SHARED_PREFETCH_WORKERS. Nothing is
+                            prefetched when neither is set.
+        :type max_workers: Optional[int]
+        :returns: Number of units whose data was loaded.
+        :rtype: int
+        """
+        if max_workers is None:
+            try:
+                max_workers = int(
+                    os.environ.get(PREFETCH_WORKERS_ENV_VAR) or 0)
+            except ValueError:
+                hookenv.log('Ignoring invalid {}'.format(
+                    PREFETCH_WORKERS_ENV_VAR), level=hookenv.WARNING)
+                max_workers = 0
+        if max_workers < 1:
+            return 0
+        # Units are listed here, as the listing of each relation is cached
+        # on the relation object and must not be raced for
+        units = [unit for relation in self.relations
+                 for unit in relation.joined_units]
+        if not units:
+            return 0
+        # Imported here as threads are only needed when prefetching
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_workers, len(units))) as executor:
+            # Reading received loads the data, and keeps it on the unit
+            for _ in executor.map(lambda unit: unit.received, units):
+                pass
+        return len(units)
 
     def available(self):
-        for unit in self.all_joined_units:
-            if unit.received['username']:
-                return True
-            for key in unit.received.keys():
-                if "_username" in key:
-                    return True
-        return False
+        # The index only holds units with at least one pending request
+        return bool(self.requests_index())
+
+    def requests_index(self):
+        """Return the index of database requests made by the remote units.
+
+        The index is persisted between hooks and built from scratch only
+        when it does not exist yet. Building it reads the data of every
+        joined unit, prefetched concurrently when
+        MYSQL_SHARED_PREFETCH_WORKERS is set. Otherwise it is brought up to
+        date with the current hook the first time it is read in the hook,
+        see _refresh_requests_index(), so that it is current no matter which
+        handler reads it first.
+
+        :returns: Requested fields keyed by relation id, unit name and
+                  prefix, '' for the unprefixed request.
+        :rtype: Dict[str, Dict[str, Dict[str, Dict[str, Any]]]]
+        """
+        if self._requests_index is None:
+            index = unitdata.kv().get(self._requests_index_key)
+            if index is None:
+                index = {}
+                versions = {}
+                self.prefetch_received()
+                for relation in self.relations:
+                    for unit in relation.joined_units:
+                        self._index_unit(
+                            index, versions, relation.relation_id, unit)
+                unitdata.kv().set(self._requests_index_key, index)
+                unitdata.kv().set(self._protocol_versions_key, versions)
+                self._protocol_versions = versions
+            else:
+                self._refresh_requests_index(index)
+            self._requests_index = index
+        return self._requests_index
+
+    def _refresh_requests_index(self, index):
+        """Bring the persisted requests index up to date with the hook.
+
+        Remote data only changes in relation hooks for the unit that changed
+        it, so only that unit is re-read. Departed units and broken relations
+        are dropped. The records are only written back when they changed.
+        """
+        versions = self.protocol_versions()
+        relation_ids = self.relation_ids()
+        index_changed = versions_changed = False
+        if hookenv.hook_name().startswith(self.endpoint_name + '-relation-'):
+            relation_id = hookenv.relation_id()
+            unit_name = hookenv.remote_unit()
+            if relation_id in relation_ids and unit_name:
+                entry = index.get(relation_id, {}).get(unit_name)
+                version = versions.get(relation_id, {}).get(unit_name)
+                for record in (index, versions):
+                    units = record.get(relation_id, {})
+                    units.pop(unit_name, None)
+                    if not units:
+                        record.pop(relation_id, None)
+                for unit in self.relations[relation_id].joined_units:
+                    if unit.unit_name == unit_name:
+                        self._index_unit(index, versions, relation_id, unit)
+                        break
+                index_changed = (
+                    index.get(relation_id, {}).get(unit_name) != entry)
+                versions_changed = (
+                    versions.get(relation_id, {}).get(unit_name) != version)
+        joined = {}
+        for relation_id in set(index) | set(versions):
+            if relation_id in relation_ids:
+                joined[relation_id] = {
+                    unit.unit_name for unit in
+                    self.relations[relation_id].joined_units}
+        index_changed |= self._drop_departed(index, joined)
+        versions_changed |= self._drop_departed(versions, joined)
+        if index_changed:
+            unitdata.kv().set(self._requests_index_key, index)
+        if versions_changed:
+            unitdata.kv().set(self._protocol_versions_key, versions)
+        serviced = self._serviced_fingerprints()
+        for relation_id in list(serviced):
+            if relation_id not in relation_ids:
+                # Relation is broken
+                del serviced[relation_id]
+                self._serviced_changed()
+
+    @staticmethod
+    def _drop_departed(record, joined):
+        """Drop the units of record that are not joined any more.
+
+        :param record: Values keyed by relation id and unit name.
+        :type record: Dict[str, Dict[str, Any]]
+        :param joined: Names of the joined units keyed by relation id,
+                       relations that are not listed are broken.
+        :type joined: Dict[str, Set[str]]
+        :returns: Whether anything was dropped.
+        :rtype: bool
+        """
+        dropped = False
+        for relation_id in list(record):
+            units = record[relation_id]
+            for unit_name in list(units):
+                if unit_name not in joined.get(relation_id, ()):
+                    del units[unit_name]
+                    dropped = True
+            if not units:
+                del record[relation_id]
+                dropped = True
+        return dropped
+
+    def protocol_versions(self):
+        """Return the protocol versions advertised by the remote units.
+
+        Only units with requests are recorded. The record is kept up to date
+        along with the requests index.
+
+        :returns: Versions keyed by relation id and unit name.
+        :rtype: Dict[str, Dict[str, int]]
+        """
+        if self._protocol_versions is None:
+            versions = unitdata.kv().get(self._protocol_versions_key)
+            if versions is None:
+                # Index persisted before versions were recorded
+                versions = {}
+                for relation in self.relations:
+                    for unit in relation.joined_units:
+                        if unit_requests(unit.received):
+                            versions.setdefault(relation.relation_id, {})[
+                                unit.unit_name] = unit_protocol_version(
+                                    unit.received)
+                unitdata.kv().set(self._protocol_versions_key, versions)
+            self._protocol_versions = versions
+        return self._protocol_versions
+
+    def protocol_version(self, relation_id):
+        """Return the protocol version to publish with on a relation.
+
+        :returns: The current version of the protocol when every unit with
+                  requests on the relation supports it, 1 otherwise.
+        :rtype: int
+        """
+        units = self.requests_index().get(relation_id)
+        versions = self.protocol_versions().get(relation_id, {})
+        if units and all(versions.get(unit, 1) >= common.PROTOCOL_VERSION
+                         for unit in units):
+            return common.PROTOCOL_VERSION
+        return 1
+
+    def requests(self):
+        """Return the database requests made by the remote units.
+
+        The records are built from the requests index once per hook and
+        reused by later calls.
+
+        :returns: Requests ordered by relation id, unit name and prefix.
+        :rtype: Tuple[SharedDBRequest, ...]
+        """
+        if self._requests is None:
+            requests = []
+            index = self.requests_index()
+            for relation_id in sorted(index):
+                units = index[relation_id]
+                for unit_name in sorted(units):
+                    prefixes = units[unit_name]
+                    for prefix in sorted(prefixes):
+                        fields = prefixes[prefix]
+                        requests.append(SharedDBRequest(
+                            relation_id, unit_name, prefix or None,
+                            fields.get('database'), fields.get('username'),
+                            fields.get('hostname')))
+            self._requests = tuple(requests)
+        return self._requests
+
+    def requested_connections(self):
+        """Return the number of connections requested by the remote units.
+
+        :returns: Total of the connections requested by the units of each
+                  relation, keyed by relation id and then by prefix, None
+                  for the unprefixed request. Requests that did not ask for
+                  a number of connections are left out.
+        :rtype: Dict[str, Dict[Optional[str], int]]
+        """
+        totals = {}
+        for relation_id, units in self.requests_index().items():
+            for unit_name, prefixes in units.items():
+                for prefix, fields in prefixes.items():
+                    try:
+                        connections = int(fields['connections'])
+                    except KeyError:
+                        continue
+                    except (TypeError, ValueError):
+                        hookenv.log(
+                            'Ignoring invalid connections from {}'.format(
+                                unit_name), level=hookenv.WARNING)
+                        continue
+                    relation_totals = totals.setdefault(relation_id, {})
+                    relation_totals[prefix or None] = (
+                        relation_totals.get(prefix or None, 0) + connections)
+        return totals
+
+    def pending_requests(self):
+        """Return the requests that have not been serviced yet.
+
+        A (relation, prefix) pair is serviced when set_db_connection_info()
+        has been called for it. It becomes pending again as soon as any unit
+        adds, changes or withdraws its request for that prefix.
+
+        :returns: Requests ordered by relation id, unit name and prefix.
+        :rtype: Tuple[SharedDBRequest, ...]
+        """
+        fingerprints = self._request_fingerprints()
+        serviced = self._serviced_fingerprints()
+        pending = []
+        for request in self.requests():
+            fingerprint = serviced.get(request.relation_id, {}).get(
+                request.prefix or '')
+            key = (request.relation_id, request.prefix)
+            if fingerprint != fingerprints[key]:
+                pending.append(request)
+        return tuple(pending)
+
+    def pending_requests_batch(self, limit):
+        """Return at most limit pending requests, resuming after the cursor.
+
+        The cursor is persisted between hooks so that successive batches
+        work through all of the pending requests before starting over. The
+        {endpoint_name}.pending flag is set while more requests are pending
+        than were handed out, so that the next hook can pick up the rest.
+
+        :param limit: Maximum number of requests to return.
+        :type limit: int
+        :returns: Requests ordered by relation id, unit name and prefix,
+                  starting after the last request handed out.
+        :rtype: Tuple[SharedDBRequest, ...]
+        """
+        pending = self.pending_requests()
+        keys = [self._cursor(request) for request in pending]
+        cursor = unitdata.kv().get(self._cursor_key)
+        start = bisect.bisect_right(keys, tuple(cursor)) if cursor else 0
+        batch = (pending[start:] + pending[:start])[:limit]
+        if batch:
+            unitdata.kv().set(self._cursor_key, self._cursor(batch[-1]))
+        reactive.toggle_flag(
+            self.expand_name('{endpoint_name}.pending'),
+            len(pending) > len(batch))
+        return batch
+
+    @staticmethod
+    def _cursor(request):
+        return (request.relation_id, request.unit, request.prefix or '')
+
+    def _request_fingerprints(self):
+        """Fingerprint the requests made under each (relation, prefix) pair.
+
+        :rtype: Dict[Tuple[str, Optional[str]], str]
+        """
+        if self._fingerprints is None:
+            groups = collections.defaultdict(list)
+            for request in self.requests():
+                groups[(request.relation_id, request.prefix)].append(
+                    request[1:])
+            self._fingerprints = {
+                key: hashlib.sha256(
+                    json.dumps(group, sort_keys=True).encode()).hexdigest()
+                for key, group in groups.items()}
+        return self._fingerprints
+
+    def _serviced_fingerprints(self):
+        if self._serviced is None:
+            self._serviced = unitdata.kv().get(self._serviced_key) or {}
+        return self._serviced
+
+    def _mark_serviced(self, relation_id, prefix=None):
+        fingerprint = self._request_fingerprints().get(
+            (relation_id, prefix or None))
+        serviced = self._serviced_fingerprints()
+        prefixes = serviced.setdefault(relation_id, {})
+        if prefixes.get(prefix or '') != fingerprint:
+            prefixes[prefix or ''] = fingerprint
+            self._serviced_changed()
+
+    def _serviced_changed(self):
+        # Written once at the end of the hook, however many requests get
+        # serviced, as the framework does with the relation data
+        if not self._serviced_dirty:
+            self._serviced_dirty = True
+            hookenv.atexit(self._flush_serviced)
+
+    def _flush_serviced(self):
+        if self._serviced_dirty:
+            unitdata.kv().set(self._serviced_key, self._serviced)
+            self._serviced_dirty = False
+
+    def _invalidate_requests(self):
+        self._requests = None
+        self._fingerprints = None
+
+    @property
+    def _requests_index_key(self):
+        return self.expand_name('{endpoint_name}.requests-index')
+
+    @property
+    def _cursor_key(self):
+        return self.expand_name('{endpoint_name}.cursor')
+
+    @property
+    def _serviced_key(self):
+        return self.expand_name('{endpoint_name}.serviced')
+
+    @property
+    def _protocol_versions_key(self):
+        return self.expand_name('{endpoint_name}.protocol-versions')
+
+    @staticmethod
+    def _index_unit(index, versions, relation_id, unit):
+        requests = unit_requests(unit.received)
+        if requests:
+            index.setdefault(relation_id, {})[unit.unit_name] = requests
+            versions.setdefault(relation_id, {})[unit.unit_name] = (
+                unit_protocol_version(unit.received))
 
     @reactive.when('endpoint.{endpoint_name}.joined')
     def joined(self):
-        reactive.clear_flag(self.expand_name('{endpoint_name}.available'))
-        reactive.set_flag(self.expand_name('{endpoint_name}.connected'))
-        self.set_ingress_address()
+        with instrumentation.profiled(self.endpoint_name, 'joined'):
+            reactive.clear_flag(self.expand_name('{endpoint_name}.available'))
+            reactive.set_flag(self.expand_name('{endpoint_name}.connected'))
+            self.set_ingress_address()
 
     @reactive.when('endpoint.{endpoint_name}.changed')
     def changed(self):
-        flags = (
-            self.expand_name(
-                'endpoint.{endpoint_name}.changed.database'),
-            self.expand_name(
-                'endpoint.{endpoint_name}.changed.username'),
-            self.expand_name(
-                'endpoint.{endpoint_name}.changed.hostname'),
-        )
-        if reactive.all_flags_set(*flags):
-            for flag in flags:
-                reactive.clear_flag(flag)
+        with instrumentation.profiled(self.endpoint_name, 'changed'):
+            flags = (
+                self.expand_name(
+                    'endpoint.{endpoint_name}.changed.database'),
+                self.expand_name(
+                    'endpoint.{endpoint_name}.changed.username'),
+                self.expand_name(
+                    'endpoint.{endpoint_name}.changed.hostname'),
+            )
+            if reactive.all_flags_set(*flags):
+                for flag in flags:
+                    reactive.clear_flag(flag)
 
-        if self.available():
-            reactive.set_flag(self.expand_name('{endpoint_name}.available'))
-        else:
-            reactive.clear_flag(self.expand_name('{endpoint_name}.available'))
+            available = self.expand_name('{endpoint_name}.available')
+            if self.available():
+                reactive.set_flag(available)
+            else:
+                reactive.clear_flag(available)
 
     def remove(self):
         flags = (
@@ -74,34 +607,191 @@ class MySQLSharedProvides(reactive.Endpoint):
 
     @reactive.when('endpoint.{endpoint_name}.broken')
     def broken(self):
-        self.remove()
+        with instrumentation.profiled(self.endpoint_name, 'broken'):
+            self.remove()
 
     @reactive.when('endpoint.{endpoint_name}.departed')
     def departed(self):
-        self.remove()
+        with instrumentation.profiled(self.endpoint_name, 'departed'):
+            self.remove()
 
     def set_db_connection_info(
             self, relation_id, db_host, password,
             allowed_units=None, prefix=None, wait_timeout=None, db_port=3306,
-            ssl_ca=None):
+            ssl_ca=None, db_ro_hosts=_UNCHANGED, prefix_db_ro_hosts=None,
+            db_hosts=_UNCHANGED, prefix_db_host=None, prefix_db_port=None):
         # Implementations of shared-db pre-date the json encoded era of
         # interface layers. In order not to have to update dozens of charms,
-        # publish in raw data
+        # publish in raw data. Only keys whose value differs from what is
+        # already published are written, so that a no-op hook does not fire
+        # -changed hooks on every consumer unit.
+        # Read replicas are published for the whole relation with
+        # db_ro_hosts, and for the requested prefix only with
+        # prefix_db_ro_hosts. Equivalent endpoints consumers can spread
+        # over are given with db_hosts, see format_endpoints(). Both are left
+        # as published when not given, and withdrawn when None. A prefix can
+        # be placed on another server with prefix_db_host and
+        # prefix_db_port.
+        relation = self.relations[relation_id]
+        changed = self._publish_shared_info(
+            relation, db_host, wait_timeout=wait_timeout, db_port=db_port,
+            ssl_ca=ssl_ca, db_ro_hosts=db_ro_hosts, db_hosts=db_hosts)
+        changed += self._publish_credentials(
+            relation, password, allowed_units=allowed_units, prefix=prefix,
+            overrides={'db_host': prefix_db_host,
+                       'db_port': prefix_db_port,
+                       'db_ro_hosts': prefix_db_ro_hosts})
+        self._mark_serviced(relation_id, prefix=prefix)
+        return changed
+
+    def set_db_connection_info_bulk(
+            self, connection_info, db_host, wait_timeout=None, db_port=3306,
+            ssl_ca=None, db_ro_hosts=_UNCHANGED, db_hosts=_UNCHANGED):
+        """Publish connection information for many relations in one pass.
 
+        The shared, unprefixed keys are written once per relation no matter
+        how many prefixes are being serviced on it.
+
+        :param connection_info: Credentials keyed by relation id and then by
+                                prefix, use None as the prefix for unprefixed
+                                requests. The server and read replicas of
+                                a prefix can be given with 'db_host',
+                                'db_port' and 'db_ro_hosts'. e.g.
+                                {'shared-db:19': {
+                                    'nova': {'password': 'pw',
+                                             'allowed_units': 'nova/0'}}}
+        :type connection_info: Dict[str, Dict[Optional[str], Dict[str, str]]]
+        :param db_host: Address of the database server.
+        :type db_host: str
+        :param wait_timeout: Optional wait_timeout to publish.
+        :type wait_timeout: Optional[int]
+        :param db_port: Port of the database server.
+        :type db_port: int
+        :param ssl_ca: Optional CA certificate to publish.
+        :type ssl_ca: Optional[str]
+        :param db_ro_hosts: Optional addresses of the read replicas of all of
+                            the databases. Left as published when not
+                            given, None withdraws them.
+        :type db_ro_hosts: Optional[Iterable[str]]
+        :param db_hosts: Optional weighted endpoints equivalent to db_host,
+                         see format_endpoints(). Left as published when not
+                         given, None withdraws them.
+        :type db_hosts: Optional[Iterable[Union[str, Tuple[str, float]]]]
+        :returns: Number of relation keys that actually changed.
+        :rtype: int
+        """
+        changed = 0
+        for relation in self.relations:
+            credentials = connection_info.get(relation.relation_id)
+            if not credentials:
+                continue
+            changed += self._publish_shared_info(
+                relation, db_host, wait_timeout=wait_timeout,
+                db_port=db_port, ssl_ca=ssl_ca, db_ro_hosts=db_ro_hosts,
+                db_hosts=db_hosts)
+            for prefix, info in credentials.items():
+                changed += self._publish_credentials(
+                    relation, info['password'],
+                    allowed_units=info.get('allowed_units'), prefix=prefix,
+                    overrides={field: info.get(field)
+                               for field in PREFIX_OVERRIDES})
+                self._mark_serviced(relation.relation_id, prefix=prefix)
+        return changed
+
+    def set_granted_connections(self, relation_id, granted):
+        """Publish the number of connections granted on a relation.
+
+        :param relation_id: Relation to publish on.
+        :type relation_id: str
+        :param granted: Connections each unit of the relation may open,
+                        keyed by prefix, use None as the prefix for the
+                        unprefixed request. An empty mapping withdraws the
+                        grants.
+        :type granted: Dict[Optional[str], int]
+        :returns: Number of relation keys that actually changed.
+        :rtype: int
+        """
+        relation = self.relations[relation_id]
+        value = {prefix or '': int(connections)
+                 for prefix, connections in granted.items()}
+        return self._publish(
+            relation, common.GRANTED_CONNECTIONS_KEY,
+            json.dumps(value, sort_keys=True) if value else None)
+
+    def _publish_shared_info(
+            self, relation, db_host, wait_timeout=None, db_port=3306,
+            ssl_ca=None, db_ro_hosts=_UNCHANGED, db_hosts=_UNCHANGED):
         # No prefix for db_host and wait_timeout
-        self.relations[relation_id].to_publish_raw["db_host"] = db_host
-        self.relations[relation_id].to_publish_raw["db_port"] = db_port
+        changed = self._publish(relation, "db_host", db_host)
+        changed += self._publish(relation, "db_port", db_port)
+        # Unset when None, so that endpoints taken out are withdrawn
+        if db_ro_hosts is not _UNCHANGED:
+            changed += self._publish(
+                relation, "db_ro_hosts", format_hosts(db_ro_hosts))
+        if db_hosts is not _UNCHANGED:
+            changed += self._publish(
+                relation, "db_hosts", format_endpoints(db_hosts))
         if wait_timeout:
-            self.relations[relation_id].to_publish_raw["wait_timeout"] = (
-                wait_timeout)
+            changed += self._publish(relation, "wait_timeout", wait_timeout)
         if ssl_ca:
-            self.relations[relation_id].to_publish_raw["ssl_ca"] = ssl_ca
-        if not prefix:
-            self.relations[relation_id].to_publish_raw["password"] = password
-            self.relations[relation_id].to_publish_raw[
-                "allowed_units"] = allowed_units
-        else:
-            self.relations[relation_id].to_publish_raw[
-                "{}_password".format(prefix)] = password
-            self.relations[relation_id].to_publish_raw[
-                "{}_allowed_units".format(prefix)] = allowed_units
+            changed += self._publish(relation, "ssl_ca", ssl_ca)
+        return changed
+
+    def _publish_credentials(
+            self, relation, password, allowed_units=None, prefix=None,
+            overrides=None):
+        fields = {'password': password, 'allowed_units': allowed_units}
+        # Unprefixed requests use the shared keys
+        if prefix:
+            fields.update((field, None) for field in PREFIX_OVERRIDES)
+            fields.update(overrides or {})
+            fields['db_ro_hosts'] = format_hosts(fields['db_ro_hosts'])
+        keys = {field: "{}_{}".format(prefix, field) if prefix else field
+                for field in fields}
+        published = relation.to_publish_raw.get(common.CREDENTIALS_KEY)
+        credentials = json.loads(published) if published else {}
+        version = self.protocol_version(relation.relation_id)
+        if version >= common.PROTOCOL_VERSION:
+            credentials[prefix or ''] = {
+                field: value for field, value in fields.items()
+                if value is not None or field not in PREFIX_OVERRIDES}
+            changed = self._publish(
+                relation, common.PROTOCOL_VERSION_KEY, version)
+            changed += self._publish(
+                relation, common.CREDENTIALS_KEY,
+                json.dumps(credentials, sort_keys=True))
+            # The raw keys are only read by legacy units
+            for key in keys.values():
+                changed += self._publish(relation, key, None)
+            return changed
+        changed = 0
+        for field, value in fields.items():
+            changed += self._publish(relation, keys[field], value)
+        # A legacy unit joined a relation that was using version 2, which
+        # is not advertised any more
+        changed += self._publish(relation, common.PROTOCOL_VERSION_KEY, None)
+        if credentials.pop(prefix or '', None) is not None:
+            changed += self._publish(
+                relation, common.CREDENTIALS_KEY,
+                json.dumps(credentials, sort_keys=True)
+                if credentials else None)
+        return changed
+
+    @staticmethod
+    def _publish(relation, key, value):
+        """Publish key on relation unless the same value is already there.
+
+        Published data read back from the relation is always a string, so
+        compare on the string form of the value.
+
+        :returns: 1 if the key was written, 0 otherwise.
+        :rtype: int
+        """
+        current = relation.to_publish_raw.get(key)
+        if value is None:
+            if current is None:
+                return 0
+        elif current is not None and str(current) == str(value):
+            return 0
+        relation.to_publish_raw[key] = value
+        return 1
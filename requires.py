@@ -1,120 +1,669 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import tempfile
+
 from charmhelpers.core import hookenv
-from charms.reactive import RelationBase
-from charms.reactive import hook
-from charms.reactive import scopes
+from charmhelpers.core import unitdata
+from charms import reactive
+
+try:
+    from . import common
+    from . import instrumentation
+except ImportError:
+    # Imported as top level modules, as in the unit tests
+    import common
+    import instrumentation
+
+# Remote keys that feed the {endpoint_name}.available flag, optionally
+# prefixed
+BASE_KEYS = ('db_host', 'password', 'allowed_units')
+
+# SSL material that can be written to disk with write_ssl_file(), with the
+# mode of the files
+SSL_FILE_MODES = {'ssl_ca': 0o644, 'ssl_cert': 0o644, 'ssl_key': 0o600}
+
+# Start of PEM encoded SSL material
+PEM_HEADER = b'-----BEGIN'
+
+# Fields configured locally for each, optionally prefixed, database
+LOCAL_FIELDS = ('database', 'username', 'hostname')
+
+
+def _decode_ssl_material(value):
+    """Return SSL material as bytes, decoded from base64 if it is encoded.
+
+    Only base64 encoded PEM is decoded, anything else is returned as given
+    even when it happens to be valid base64.
+    """
+    material = value.encode('utf-8')
+    if material.lstrip().startswith(PEM_HEADER):
+        return material
+    try:
+        decoded = base64.b64decode(''.join(value.split()), validate=True)
+    except ValueError:
+        return material
+    if decoded.lstrip().startswith(PEM_HEADER):
+        return decoded
+    return material
+
 
+def _write_atomically(path, content, mode):
+    """Write content to path so that readers never see a partial file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        try:
+            f = os.fdopen(fd, 'wb')
+        except BaseException:
+            os.close(fd)
+            raise
+        with f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Not raised over the original error
+        _remove_file(tmp_path)
+        raise
 
-class MySQLSharedRequires(RelationBase):
-    scope = scopes.GLOBAL
 
-    # These remote data fields will be automatically mapped to accessors
-    # with a basic documentation string provided.
-    auto_accessors = ['access-network', 'db_host', 'db_port',
-                      'ssl_ca', 'ssl_cert', 'ssl_key',
-                      'cluster-series-upgrading', 'wait_timeout']
+def _remove_file(path):
+    """Remove path, if it still exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        hookenv.log('Unable to remove {}: {}'.format(path, e),
+                    level=hookenv.WARNING)
 
-    @hook('{requires:mysql-shared}-relation-joined')
+
+class MySQLSharedRequires(reactive.Endpoint):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        instrumentation.install(self.endpoint_name)
+        # Parsed allowed_units keyed by prefix
+        self._allowed_units_sets = {}
+        # All remote data, loaded once per hook
+        self._remote_snapshot = None
+        # Local database configuration, loaded once per hook
+        self._local_state = None
+        # Paths of the SSL material written in this hook, keyed by field
+        self._ssl_files = {}
+
+    @reactive.when('endpoint.{endpoint_name}.joined')
     def joined(self):
-        self.set_state('{relation_name}.connected')
+        with instrumentation.profiled(self.endpoint_name, 'joined'):
+            reactive.set_flag(self.expand_name('{endpoint_name}.connected'))
 
-    @hook('{requires:mysql-shared}-relation-changed')
+    @reactive.when('endpoint.{endpoint_name}.changed')
     def changed(self):
+        with instrumentation.profiled(self.endpoint_name, 'changed'):
+            changed_keys = self._changed_keys()
+            self.update_flags(changed_keys)
+            for key in changed_keys:
+                reactive.clear_flag(self.expand_name('changed.' + key))
+            reactive.clear_flag(self.expand_name('changed'))
+
+    def remove(self):
+        flags = (
+            self.expand_name('{endpoint_name}.connected'),
+            self.expand_name('{endpoint_name}.available'),
+            self.expand_name('{endpoint_name}.available.access_network'),
+            self.expand_name('{endpoint_name}.available.ssl'),
+            self.expand_name('{endpoint_name}.available.read_replicas'),
+            self.expand_name('{endpoint_name}.series-upgrading'),
+        )
+        for flag in flags:
+            reactive.clear_flag(flag)
+
+    @reactive.when('endpoint.{endpoint_name}.departed')
+    def departed(self):
+        with instrumentation.profiled(self.endpoint_name, 'departed'):
+            # Clear state
+            self.remove()
+            reactive.clear_flag(self.expand_name('departed'))
+            # The departing unit is already excluded from the joined units and
+            # from the remote data, so check the remaining membership once and
+            # if this is not the last unit re-evaluate state once. A relation
+            # is broken after its last unit departed, the framework raises no
+            # flag for it, so the state of the relations that remain is
+            # re-evaluated here.
+            if self.all_joined_units:
+                self.joined()
+                self.update_flags()
+
+    def update_flags(self, changed_keys=None):
+        """
+        Re-evaluate the availability flags.
+
+        Only the flags whose inputs are among changed_keys are evaluated, a
+        change to cluster-series-upgrading re-evaluates all of them. The
+        framework raises no changed flag for a key the remote units unset,
+        so the end of a series upgrade is detected from the flag set when
+        it started rather than from changed_keys.
+
+        :param changed_keys: Remote keys that changed, None to evaluate all
+                             flags.
+        :type changed_keys: Optional[Set[str]]
+        """
+        upgrading = self.expand_name('{endpoint_name}.series-upgrading')
         if self.cluster_series_upgrading() == 'True':
-            self.remove_state('{relation_name}.available')
-            self.remove_state('{relation_name}.available.access_network')
-            self.remove_state('{relation_name}.available.ssl')
-        else:
+            reactive.set_flag(upgrading)
+            reactive.clear_flag(
+                self.expand_name('{endpoint_name}.available'))
+            reactive.clear_flag(
+                self.expand_name('{endpoint_name}.available.access_network'))
+            reactive.clear_flag(
+                self.expand_name('{endpoint_name}.available.ssl'))
+            reactive.clear_flag(self.expand_name(
+                '{endpoint_name}.available.read_replicas'))
+            return
+        if reactive.is_flag_set(upgrading):
+            reactive.clear_flag(upgrading)
+            changed_keys = None
+        elif 'cluster-series-upgrading' in (changed_keys or ()):
+            changed_keys = None
+
+        def _changed(match):
+            return changed_keys is None or any(map(match, changed_keys))
+
+        if _changed(self._is_base_key):
             if self.base_data_complete() and self.unit_allowed_all_dbs():
-                self.set_state('{relation_name}.available')
+                reactive.set_flag(
+                    self.expand_name('{endpoint_name}.available'))
+        if _changed(lambda key: key == 'access-network'):
             if self.access_network_data_complete():
-                self.set_state('{relation_name}.available.access_network')
+                reactive.set_flag(self.expand_name(
+                    '{endpoint_name}.available.access_network'))
+        if _changed(lambda key: key == 'ssl_ca'):
             if self.ssl_data_complete():
-                self.set_state('{relation_name}.available.ssl')
+                reactive.set_flag(
+                    self.expand_name('{endpoint_name}.available.ssl'))
+        # Unlike the other optional data, replicas can be withdrawn by
+        # unsetting their key, which raises no changed flag, so this flag is
+        # evaluated on every run from the remote data already loaded.
+        flag = self.expand_name('{endpoint_name}.available.read_replicas')
+        if self.read_replicas_data_complete():
+            reactive.set_flag(flag)
+        else:
+            reactive.clear_flag(flag)
 
-    @hook('{requires:mysql-shared}-relation-{broken,departed}')
-    def departed(self):
-        # Clear state
-        self.remove_state('{relation_name}.connected')
-        self.remove_state('{relation_name}.available')
-        self.remove_state('{relation_name}.available.access_network')
-        self.remove_state('{relation_name}.available.ssl')
-        # Check if this is the last unit
-        for conversation in self.conversations():
-            for rel_id in conversation.relation_ids:
-                if len(hookenv.related_units(rel_id)) > 0:
-                    # This is not the last unit so reevaluate state
-                    self.joined()
-                    self.changed()
-
-    def configure(self, database, username, hostname=None, prefix=None):
+    def _changed_keys(self):
         """
-        Called by charm layer that uses this interface to configure a database.
+        Return the remote keys flagged as changed by the framework.
         """
-        if not hostname:
-            conversation = self.conversation()
+        prefix = self.expand_name('changed.')
+        return {flag[len(prefix):] for flag in reactive.get_flags()
+                if flag.startswith(prefix)}
+
+    @staticmethod
+    def _is_base_key(key):
+        return key == common.CREDENTIALS_KEY or any(
+            key == base or key.endswith('_' + base) for base in BASE_KEYS)
+
+    def remote_data(self):
+        """
+        Return all of the data set by the remote units.
+
+        The data is read once per remote unit the first time it is needed in
+        a hook and reused afterwards, so the number of hook tool calls does
+        not grow with the number of prefixes. Credentials received in the
+        JSON encoded credentials key are decoded once and returned under the
+        raw keys they replace.
+
+        :returns: Remote data, the first unit to set a key wins.
+        :rtype: Dict[str, str]
+        """
+        if self._remote_snapshot is None:
+            self._remote_snapshot = self._load_remote_data()
+        return self._remote_snapshot
+
+    def _load_remote_data(self):
+        # The departing unit is not part of all_joined_units, and the first
+        # unit to set a key wins.
+        data = {}
+        for unit in self.all_joined_units:
+            for key, value in unit.received_raw.items():
+                if value and not data.get(key):
+                    data[key] = value
+        credentials = data.pop(common.CREDENTIALS_KEY, None)
+        if credentials:
             try:
-                hostname = hookenv.network_get_primary_address(
-                    conversation.relation_name
-                )
-            except NotImplementedError:
-                hostname = hookenv.unit_private_ip()
+                credentials = json.loads(credentials)
+            except ValueError:
+                hookenv.log(
+                    'Ignoring invalid {}'.format(common.CREDENTIALS_KEY),
+                    level=hookenv.WARNING)
+                credentials = {}
+            for prefix, fields in credentials.items():
+                for field, value in fields.items():
+                    # As strings, like the raw keys they replace, whatever
+                    # their JSON type, such as the int of a db_port
+                    if value:
+                        data['{}_{}'.format(prefix, field)
+                             if prefix else field] = str(value)
+        return data
 
+    def get_remote(self, key, default=None):
+        """
+        Get a value set by the remote units, see remote_data().
+        """
+        return self.remote_data().get(key) or default
+
+    def set_remote(self, **data):
+        """
+        Publish data to the remote units on all relations.
+        """
+        for relation in self.relations:
+            relation.to_publish_raw.update(data)
+
+    @property
+    def _local_prefix(self):
+        # Same namespace the RelationBase implementation stored its global
+        # conversation data in, so configuration survives an upgrade.
+        return 'reactive.conversations.{}.global.local-data.'.format(
+            self.endpoint_name)
+
+    def get_local(self, key, default=None):
+        """
+        Retrieve some data previously set via set_local().
+        """
+        return unitdata.kv().get(self._local_prefix + key, default)
+
+    def local_state(self):
+        """
+        Return the locally stored database configuration.
+
+        All of the configuration is kept in a single unitdata record that is
+        loaded once per hook, and written back only when it changes.
+
+        :returns: {'prefixes': [prefix, ...],
+                   'databases': {prefix: {'database': ..., 'username': ...,
+                                          'hostname': ...}}}
+                  with '' as the prefix of the unprefixed database.
+        :rtype: Dict[str, Any]
+        """
+        if self._local_state is None:
+            state = unitdata.kv().get(self._local_state_key)
+            if state is None:
+                state = self._legacy_local_state()
+            self._local_state = state
+        return self._local_state
+
+    @property
+    def _local_state_key(self):
+        return self._local_prefix + 'state'
+
+    def _legacy_local_state(self):
+        # Earlier versions stored one key per field
+        prefixes = self.get_local('prefixes') or []
+        databases = {}
+        for prefix in [''] + prefixes:
+            fields = {}
+            for field in LOCAL_FIELDS:
+                key = prefix + '_' + field if prefix else field
+                value = self.get_local(key)
+                if value:
+                    fields[field] = value
+            if fields:
+                databases[prefix] = fields
+        return {'prefixes': prefixes, 'databases': databases}
+
+    def _update_local_state(self, prefixes=(), databases=None):
+        state = self.local_state()
+        dirty = False
+        known = set(state['prefixes'])
+        for prefix in prefixes:
+            if prefix not in known:
+                known.add(prefix)
+                state['prefixes'].append(prefix)
+                dirty = True
+        for prefix, fields in (databases or {}).items():
+            if state['databases'].get(prefix) != fields:
+                state['databases'][prefix] = fields
+                dirty = True
+        if dirty:
+            unitdata.kv().set(self._local_state_key, state)
+
+    def _local_field(self, field, prefix=None):
+        return self.local_state()['databases'].get(
+            prefix or '', {}).get(field)
+
+    def set_local(self, key=None, value=None, **data):
+        """
+        Locally store some data associated with this endpoint.
+        """
+        if key is not None:
+            data[key] = value
+        if data:
+            unitdata.kv().update(data, prefix=self._local_prefix)
+
+    def access_network(self):
+        """
+        Get the access-network, if available, or None.
+        """
+        return self.get_remote('access-network')
+
+    def db_host(self, prefix=None):
+        """
+        Get the db_host of a database, if available, or None.
+
+        A host published for the prefix takes precedence over the shared one.
+        """
+        return self._get_remote_override('db_host', prefix=prefix)
+
+    def db_port(self, prefix=None):
+        """
+        Get the db_port of a database, if available, or None.
+
+        A port published for the prefix takes precedence over the shared one.
+        """
+        return self._get_remote_override('db_port', prefix=prefix)
+
+    def _get_remote_override(self, key, prefix=None):
+        value = None
         if prefix:
-            relation_info = {
-                prefix + '_database': database,
-                prefix + '_username': username,
-                prefix + '_hostname': hostname,
-            }
-            self.set_prefix(prefix)
-        else:
-            relation_info = {
+            value = self.get_remote(prefix + '_' + key)
+        return value or self.get_remote(key)
+
+    def db_hosts(self, prefix=None):
+        """
+        Return the weighted endpoints equivalent to db_host.
+
+        :param prefix: Prefix used to distinguish multiple db requests, a
+                       database placed on its own db_host only has that one.
+        :type prefix: str
+        :returns: (address, weight) in the order published by mysql, only
+                  db_host with a weight of 1 when no list was published.
+        :rtype: List[Tuple[str, float]]
+        """
+        if prefix and self.get_remote(prefix + '_db_host'):
+            return [(self.db_host(prefix=prefix), 1.0)]
+        published = self.get_remote('db_hosts')
+        if published:
+            try:
+                return [(record['host'], float(record.get('weight', 1)))
+                        for record in json.loads(published)]
+            except (TypeError, ValueError, KeyError) as e:
+                hookenv.log('Ignoring invalid db_hosts: {}'.format(e),
+                            level=hookenv.WARNING)
+        db_host = self.db_host()
+        return [(db_host, 1.0)] if db_host else []
+
+    def select_db_host(self, key=None, prefix=None):
+        """
+        Select one of the endpoints returned by db_hosts() for this unit.
+
+        The endpoint is chosen by weighted rendezvous hashing of key, so the
+        same key keeps getting the same endpoint, consumers spread over the
+        endpoints in proportion to their weights, and adding or removing an
+        endpoint only moves the consumers that picked it or now pick it.
+
+        :param key: Key to select an endpoint for, the name of the local
+                    unit by default.
+        :type key: Optional[str]
+        :param prefix: Prefix used to distinguish multiple db requests.
+        :type prefix: str
+        :returns: Selected address, None if mysql published none.
+        :rtype: Optional[str]
+        """
+        if key is None:
+            key = hookenv.local_unit()
+        best, best_score = None, None
+        for host, weight in self.db_hosts(prefix=prefix):
+            if weight <= 0:
+                continue
+            digest = hashlib.sha256(
+                '{}\0{}'.format(key, host).encode('utf-8')).digest()
+            # Uniform in (0, 1), never 0 or 1
+            uniform = (int.from_bytes(digest[:8], 'big') + 1) / (2 ** 64 + 2)
+            score = -weight / math.log(uniform)
+            if best_score is None or score > best_score:
+                best, best_score = host, score
+        return best
+
+    def db_ro_hosts(self, prefix=None):
+        """
+        Return the addresses of a database's read replicas.
+
+        Replicas published for the prefix take precedence over the ones
+        published for all of the databases.
+
+        :param prefix: Prefix used to distinguish multiple db requests.
+        :type prefix: str
+        :returns: Addresses of the read replicas, empty if there are none.
+        :rtype: List[str]
+        """
+        hosts = self._get_remote_override('db_ro_hosts', prefix=prefix)
+        return (hosts or '').split()
+
+    def granted_connections(self, prefix=None):
+        """
+        Return the number of connections mysql granted this unit.
+
+        :param prefix: Prefix used to distinguish multiple db requests.
+        :type prefix: str
+        :returns: Connections the unit may open to the database, None if
+                  mysql granted none.
+        :rtype: Optional[int]
+        """
+        published = self.get_remote(common.GRANTED_CONNECTIONS_KEY)
+        if not published:
+            return None
+        try:
+            granted = json.loads(published).get(prefix or '')
+            return None if granted is None else int(granted)
+        except (AttributeError, TypeError, ValueError):
+            hookenv.log(
+                'Ignoring invalid {}'.format(common.GRANTED_CONNECTIONS_KEY),
+                level=hookenv.WARNING)
+            return None
+
+    def ssl_ca(self):
+        """
+        Get the ssl_ca, if available, or None.
+        """
+        return self.get_remote('ssl_ca')
+
+    def ssl_cert(self):
+        """
+        Get the ssl_cert, if available, or None.
+        """
+        return self.get_remote('ssl_cert')
+
+    def ssl_key(self):
+        """
+        Get the ssl_key, if available, or None.
+        """
+        return self.get_remote('ssl_key')
+
+    def write_ssl_file(self, field, directory):
+        """
+        Write SSL material received from mysql to a content addressed file.
+
+        The material is decoded from base64 when it is encoded, and written
+        atomically to a path named after the hash of its content, so the
+        path only changes along with the material. An existing file is not
+        written again, so its mtime stays the same. The file of superseded
+        material is removed by the first call in a later hook, once the
+        services using it have been restarted.
+
+        :param field: One of 'ssl_ca', 'ssl_cert' or 'ssl_key'.
+        :type field: str
+        :param directory: Directory to write the file in.
+        :type directory: str
+        :returns: Path of the file, None if mysql published no material,
+                  and whether it changed since the previous call for field.
+        :rtype: Tuple[Optional[str], bool]
+        """
+        mode = SSL_FILE_MODES[field]
+        value = self.get_remote(field)
+        cached = self._ssl_files.get(field)
+        if cached and cached[0] == (value, directory):
+            return cached[1], False
+        key = self.expand_name('{endpoint_name}.ssl-files')
+        record = unitdata.kv().get(key) or {}
+        previous = record.get(field) or {}
+        path = None
+        if value:
+            content = _decode_ssl_material(value)
+            path = os.path.join(directory, '{}-{}.pem'.format(
+                field, hashlib.sha256(content).hexdigest()[:16]))
+            if not os.path.exists(path):
+                _write_atomically(path, content, mode)
+        changed = previous.get('path') != path
+        superseded = previous.get('superseded')
+        if superseded and superseded != path:
+            _remove_file(superseded)
+        current = {'path': path,
+                   'superseded': previous.get('path') if changed else None}
+        if current != previous:
+            record[field] = current
+            unitdata.kv().set(key, record)
+        self._ssl_files[field] = ((value, directory), path)
+        return path, changed
+
+    def cluster_series_upgrading(self):
+        """
+        Get the cluster-series-upgrading, if available, or None.
+        """
+        return self.get_remote('cluster-series-upgrading')
+
+    def wait_timeout(self):
+        """
+        Get the wait_timeout, if available, or None.
+        """
+        return self.get_remote('wait_timeout')
+
+    def configure(self, database, username, hostname=None, prefix=None,
+                  connections=None):
+        """
+        Called by charm layer that uses this interface to configure a database.
+
+        The optional number of connections the unit needs to the database,
+        such as pool size times workers, is published for mysql to size
+        max_connections and grant a budget, see granted_connections().
+        """
+        if not hostname:
+            hostname = self._primary_address()
+
+        self._update_local_state(
+            prefixes=[prefix] if prefix else [],
+            databases={prefix or '': {'database': database,
+                                      'username': username,
+                                      'hostname': hostname}})
+        relation_info = self._relation_info(
+            database, username, hostname, prefix=prefix,
+            connections=connections)
+        relation_info[common.PROTOCOL_VERSION_KEY] = common.PROTOCOL_VERSION
+        self.set_remote(**relation_info)
+
+    def configure_many(self, databases, hostname=None):
+        """
+        Configure several databases with a single relation write.
+
+        :param databases: (database, username, prefix) tuples, use None as
+                          the prefix for the unprefixed database. A fourth
+                          item can give the number of connections, as
+                          configure() does.
+        :type databases: List[Tuple[str, str, Optional[str]]]
+        :param hostname: Hostname to request access from, defaults to the
+                         address of the relation's network space binding.
+        :type hostname: Optional[str]
+        """
+        if not hostname:
+            hostname = self._primary_address()
+
+        relation_info = {common.PROTOCOL_VERSION_KEY: common.PROTOCOL_VERSION}
+        prefixes = []
+        local_databases = {}
+        for database, username, prefix, *connections in databases:
+            relation_info.update(self._relation_info(
+                database, username, hostname, prefix=prefix,
+                connections=connections[0] if connections else None))
+            if prefix:
+                prefixes.append(prefix)
+            local_databases[prefix or ''] = {
                 'database': database,
                 'username': username,
-                'hostname': hostname,
-            }
+                'hostname': hostname}
+        self._update_local_state(
+            prefixes=prefixes, databases=local_databases)
         self.set_remote(**relation_info)
-        self.set_local(**relation_info)
+
+    def _primary_address(self):
+        # Cached in unitdata per binding to avoid a network-get call on
+        # every configure.
+        key = self.expand_name('{endpoint_name}.primary-address')
+        address = None
+        if hookenv.hook_name() not in common.ADDRESS_REFRESH_HOOKS:
+            address = unitdata.kv().get(key)
+        if not address:
+            try:
+                address = hookenv.network_get_primary_address(
+                    self.endpoint_name)
+            except NotImplementedError:
+                address = hookenv.unit_private_ip()
+            unitdata.kv().set(key, address)
+        return address
+
+    @staticmethod
+    def _relation_info(database, username, hostname, prefix=None,
+                       connections=None):
+        info = {
+            'database': database,
+            'username': username,
+            'hostname': hostname,
+        }
+        if connections is not None:
+            info['connections'] = connections
+        if prefix:
+            return {prefix + '_' + key: value for key, value in info.items()}
+        return info
 
     def set_prefix(self, prefix):
         """
         Store all of the database prefixes in a list.
         """
-        prefixes = self.get_local('prefixes')
-        if prefixes:
-            if prefix not in prefixes:
-                self.set_local('prefixes', prefixes + [prefix])
-        else:
-            self.set_local('prefixes', [prefix])
+        self.set_prefixes([prefix])
+
+    def set_prefixes(self, prefixes):
+        """
+        Add several database prefixes to the stored list in a single write.
+        """
+        self._update_local_state(prefixes=prefixes)
 
     def get_prefixes(self):
         """
         Return the list of saved prefixes.
         """
-        return self.get_local('prefixes')
+        return self.local_state()['prefixes'] or None
 
     def database(self, prefix=None):
         """
         Return a configured database name.
         """
-        if prefix:
-            return self.get_local(prefix + '_database')
-        return self.get_local('database')
+        return self._local_field('database', prefix=prefix)
 
     def username(self, prefix=None):
         """
         Return a configured username.
         """
-        if prefix:
-            return self.get_local(prefix + '_username')
-        return self.get_local('username')
+        return self._local_field('username', prefix=prefix)
 
     def hostname(self, prefix=None):
         """
         Return a configured hostname.
         """
-        if prefix:
-            return self.get_local(prefix + '_hostname')
-        return self.get_local('hostname')
+        return self._local_field('hostname', prefix=prefix)
 
     def password(self, prefix=None):
         """
@@ -132,6 +681,24 @@ class MySQLSharedRequires(RelationBase):
             return self.get_remote(prefix + '_allowed_units')
         return self.get_remote('allowed_units')
 
+    def allowed_units_set(self, prefix=None):
+        """
+        Return a database's allowed_units as a set of unit names.
+
+        The parsed set is cached for as long as the remote value is unchanged.
+
+        :param prefix: Prefix used to distinguish multiple db requests.
+        :type prefix: str
+        :returns: Units allowed to access the database.
+        :rtype: frozenset
+        """
+        allowed_units = self.allowed_units(prefix=prefix) or ''
+        cached = self._allowed_units_sets.get(prefix)
+        if cached is None or cached[0] != allowed_units:
+            cached = (allowed_units, frozenset(allowed_units.split()))
+            self._allowed_units_sets[prefix] = cached
+        return cached[1]
+
     def base_data_complete(self):
         """
         Check if required base data is complete.
@@ -161,14 +728,11 @@ class MySQLSharedRequires(RelationBase):
         :returns: Whether db acl has been setup.
         :rtype: bool
         """
-        allowed = False
-        allowed_units = self.allowed_units(prefix=prefix) or ''
-        hookenv.log("Checking {} is in {}".format(
-            hookenv.local_unit(),
-            allowed_units.split()))
-        if allowed_units and hookenv.local_unit() in allowed_units.split():
-            allowed = True
-        hookenv.log("Unit allowed: {}".format(allowed))
+        allowed_units = self.allowed_units_set(prefix=prefix)
+        local_unit = hookenv.local_unit()
+        allowed = local_unit in allowed_units
+        hookenv.log("Unit {} allowed: {} ({} allowed units)".format(
+            local_unit, allowed, len(allowed_units)))
         return allowed
 
     def unit_allowed_all_dbs(self):
@@ -201,6 +765,16 @@ class MySQLSharedRequires(RelationBase):
             return True
         return False
 
+    def read_replicas_data_complete(self):
+        """
+        Check if optional read replica data provided by mysql is complete.
+
+        :returns: Whether every requested database has read replicas.
+        :rtype: bool
+        """
+        prefixes = self.get_prefixes() or [None]
+        return all(self.db_ro_hosts(prefix=prefix) for prefix in prefixes)
+
     def ssl_data_complete(self):
         """
         Check if optional ssl data provided by mysql is complete.
@@ -0,0 +1,144 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import importlib
+import tempfile
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+import instrumentation
+
+
+class TestInstrumentation(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self._patches = {}
+        self._patches_start = {}
+        # The wrappers installed by a test are undone with these patches
+        for module_name, name, kind in instrumentation.HOOK_TOOLS:
+            self.patch_object(importlib.import_module(module_name), name)
+        self.patch_object(instrumentation.hookenv, "atexit")
+        self.patch_object(instrumentation.hookenv, "log")
+        self.patch_object(instrumentation.hookenv, "hook_name")
+        self.hook_name.return_value = "shared-db-relation-changed"
+        self.patch_object(instrumentation.hookenv, "local_unit")
+        self.local_unit.return_value = "mysql/0"
+        self.patch_object(instrumentation.unitdata, "kv")
+        instrumentation._stats = None
+        self.environ = {}
+        self.patch_object(instrumentation.os, "environ", new=self.environ)
+
+    def tearDown(self):
+        instrumentation._stats = None
+        for k, v in self._patches.items():
+            v.stop()
+            setattr(self, k, None)
+        self._patches = None
+        self._patches_start = None
+
+    def test_install_disabled(self):
+        self.assertIsNone(instrumentation.install("shared-db"))
+        self.assertFalse(self.atexit.called)
+        self.assertIsInstance(
+            instrumentation.hookenv.relation_get, mock.MagicMock)
+
+    def test_install(self):
+        self.environ[instrumentation.ENV_VAR] = "log"
+        stats = instrumentation.install("shared-db")
+        self.assertIs(instrumentation.install("db-router"), stats)
+        self.atexit.assert_called_once_with(stats.emit)
+        self.assertEqual(stats.endpoints, {"shared-db", "db-router"})
+
+    def test_accounting(self):
+        self.environ[instrumentation.ENV_VAR] = "log"
+        network_get = self.network_get_primary_address
+        self.get_relation_ip.side_effect = (
+            lambda binding: instrumentation.hookenv.
+            network_get_primary_address(binding))
+        stats = instrumentation.install("shared-db")
+        instrumentation.hookenv.relation_get(rid="shared-db:1")
+        instrumentation.hookenv.relation_get(rid="shared-db:2")
+        instrumentation.hookenv.relation_set("shared-db:1", {"a": "b"})
+        importlib.import_module(
+            "charmhelpers.contrib.network.ip").get_relation_ip("shared-db")
+        instrumentation.unitdata.kv().get("key")
+        instrumentation.unitdata.kv().set("key", "value")
+        network_get.assert_called_once_with("shared-db")
+        self.relation_get.assert_called_with(rid="shared-db:2")
+        self.assertEqual(stats.counts, {
+            "relation-get": 2,
+            "relation-set": 1,
+            "network-get": 1,
+            "kv-get": 1,
+            "kv-set": 1,
+        })
+        summary = stats.summary()
+        self.assertEqual(summary["hook"], "shared-db-relation-changed")
+        self.assertEqual(summary["unit"], "mysql/0")
+        self.assertEqual(summary["endpoints"], ["shared-db"])
+        self.assertEqual(summary["calls"]["relation-get"]["count"], 2)
+
+    def test_emit_log(self):
+        stats = instrumentation.HookStats("log")
+        stats.counts["relation-get"] = 3
+        stats.emit()
+        record = json.loads(self.log.call_args[0][0])
+        self.assertEqual(record["calls"]["relation-get"]["count"], 3)
+
+    def test_emit_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "stats.json")
+            stats = instrumentation.HookStats(path)
+            stats.emit()
+            stats.emit()
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["hook"], "shared-db-relation-changed")
+
+    def test_emit_file_error(self):
+        stats = instrumentation.HookStats("/nonexistent/stats.json")
+        stats.emit()
+        self.assertTrue(self.log.called)
+
+    def test_profiled_disabled(self):
+        with instrumentation.profiled("shared-db", "changed"):
+            pass
+        self.assertFalse(self.log.called)
+
+    def test_profiled(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.environ[instrumentation.PROFILE_DIR_ENV_VAR] = tmpdir
+            with instrumentation.profiled("shared-db", "departed"):
+                with instrumentation.profiled("shared-db", "joined"):
+                    pass
+            dumps = os.listdir(tmpdir)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].endswith(
+            "-shared-db-relation-changed-shared-db.departed.prof"))
+
+    def test_profiled_rotation(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.environ[instrumentation.PROFILE_DIR_ENV_VAR] = tmpdir
+            self.environ[instrumentation.PROFILE_KEEP_ENV_VAR] = "2"
+            for handler in ("joined", "changed", "departed"):
+                with instrumentation.profiled("shared-db", handler):
+                    pass
+            dumps = sorted(os.listdir(tmpdir))
+        self.assertEqual(len(dumps), 2)
+        self.assertTrue(dumps[0].endswith("changed.prof"))
+        self.assertTrue(dumps[1].endswith("departed.prof"))
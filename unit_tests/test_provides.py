@@ -13,7 +13,9 @@
 # limitations under the License.
 
 import charms_openstack.test_utils as test_utils
+import json
 from unittest import mock
+import charmhelpers.contrib.network.ip as ch_net_ip
 import provides
 
 
@@ -45,6 +47,16 @@ class TestMySQLSharedProvides(test_utils.PatchHelper):
         self._patches_start = {}
         self.patch_object(provides.reactive, "clear_flag")
         self.patch_object(provides.reactive, "set_flag")
+        self.patch_object(provides.hookenv, "hook_name")
+        self.patch_object(provides.hookenv, "relation_id")
+        self.hook_name.return_value = "update-status"
+        self.patch_object(provides.hookenv, "remote_unit")
+        self.relation_id.return_value = None
+        self.remote_unit.return_value = None
+        self.kv_data = {}
+        self.patch_object(provides.unitdata, "kv")
+        self.kv.return_value.get.side_effect = self.kv_data.get
+        self.kv.return_value.set.side_effect = self.kv_data.__setitem__
 
         self.fake_unit = mock.MagicMock()
         self.fake_unit.unit_name = "myunit/4"
@@ -53,7 +65,10 @@ class TestMySQLSharedProvides(test_utils.PatchHelper):
         self.fake_relation_id = "shared-db:19"
         self.fake_relation = mock.MagicMock()
         self.fake_relation.relation_id = self.fake_relation_id
+        # Nothing published yet
+        self.fake_relation.to_publish_raw.get.return_value = None
         self.fake_relation.units = [self.fake_unit]
+        self.fake_relation.joined_units = [self.fake_unit]
 
         self.ep_name = "ep"
         self.ep = provides.MySQLSharedProvides(
@@ -121,6 +136,28 @@ class TestMySQLSharedProvides(test_utils.PatchHelper):
         self.ep.set_ingress_address()
         self.fake_relation.to_publish_raw.__setitem__.assert_has_calls(_calls)
 
+    def test_ingress_address(self):
+        self.patch_object(ch_net_ip, "get_relation_ip")
+        self.get_relation_ip.return_value = "10.0.0.1"
+        ep = provides.MySQLSharedProvides(
+            self.ep_name, [self.fake_relation_id])
+        self.assertEqual(ep.ingress_address, "10.0.0.1")
+        self.assertEqual(ep.ingress_address, "10.0.0.1")
+        self.get_relation_ip.assert_called_once_with(self.ep_name)
+        self.assertEqual(self.kv_data["ep.ingress-address"], "10.0.0.1")
+        # Cached between hooks
+        self.get_relation_ip.return_value = "10.0.0.2"
+        ep = provides.MySQLSharedProvides(
+            self.ep_name, [self.fake_relation_id])
+        self.assertEqual(ep.ingress_address, "10.0.0.1")
+        self.get_relation_ip.assert_called_once_with(self.ep_name)
+        # Resolved again in hooks where the address may change
+        self.hook_name.return_value = "config-changed"
+        ep = provides.MySQLSharedProvides(
+            self.ep_name, [self.fake_relation_id])
+        self.assertEqual(ep.ingress_address, "10.0.0.2")
+        self.assertEqual(self.kv_data["ep.ingress-address"], "10.0.0.2")
+
     def test_available_not_available(self):
         self.assertFalse(self.ep.available())
 
@@ -132,6 +169,213 @@ class TestMySQLSharedProvides(test_utils.PatchHelper):
         self.fake_unit.received["prefix_username"] = "user"
         self.assertTrue(self.ep.available())
 
+    def test_available_from_persisted_index(self):
+        self.kv_data["ep.requests-index"] = {
+            "shared-db:19": {"myunit/4": {"": {"username": "user"}}}}
+        self.fake_unit.received = {"username": None}
+        self.assertTrue(self.ep.available())
+
+    def test_requests_index(self):
+        self.fake_unit.received = {
+            "username": "user", "database": "db", "hostname": "10.0.0.1",
+            "nova_api_username": "nova", "nova_api_database": "nova_api",
+            "other_database": "incomplete"}
+        expect = {
+            self.fake_relation_id: {
+                self.fake_unit.unit_name: {
+                    "": {"username": "user", "database": "db",
+                         "hostname": "10.0.0.1"},
+                    "nova_api": {"username": "nova",
+                                 "database": "nova_api"}}}}
+        self.assertEqual(self.ep.requests_index(), expect)
+        self.assertEqual(self.kv_data["ep.requests-index"], expect)
+
+    def test_requests(self):
+        self.fake_unit.received = {
+            "username": "user", "database": "db", "hostname": "10.0.0.1",
+            "nova_username": "nova", "nova_database": "nova"}
+        requests = self.ep.requests()
+        self.assertEqual(
+            requests,
+            (provides.SharedDBRequest(
+                self.fake_relation_id, self.fake_unit.unit_name, None,
+                "db", "user", "10.0.0.1"),
+             provides.SharedDBRequest(
+                self.fake_relation_id, self.fake_unit.unit_name, "nova",
+                "nova", "nova", None)))
+        self.assertEqual(requests[1].prefix, "nova")
+        # Built once and reused
+        self.assertIs(self.ep.requests(), requests)
+        with self.assertRaises(AttributeError):
+            requests[0].username = "other"
+
+    def test_pending_requests(self):
+        self.patch_object(provides.hookenv, "atexit")
+        self.fake_relation.to_publish_raw = {}
+        self.fake_unit.received = {
+            "username": "user", "database": "db", "hostname": "10.0.0.1",
+            "nova_username": "nova", "nova_database": "nova"}
+        self.assertEqual(
+            [(r.prefix, r.username) for r in self.ep.pending_requests()],
+            [(None, "user"), ("nova", "nova")])
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "pw",
+            allowed_units=self.fake_unit.unit_name)
+        self.assertEqual(
+            [(r.prefix, r.username) for r in self.ep.pending_requests()],
+            [("nova", "nova")])
+        # Serviced requests are remembered across hooks
+        self.atexit.assert_called_once_with(self.ep._flush_serviced)
+        self.ep._flush_serviced()
+        ep = provides.MySQLSharedProvides(
+            self.ep_name, [self.fake_relation_id])
+        ep.relations[0] = self.fake_relation
+        self.assertEqual(
+            [(r.prefix, r.username) for r in ep.pending_requests()],
+            [("nova", "nova")])
+        # A changed request is pending again
+        self.fake_unit.received["hostname"] = "10.0.0.2"
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertEqual(
+            [(r.prefix, r.hostname) for r in ep.pending_requests()],
+            [(None, "10.0.0.2"), ("nova", None)])
+
+    def test_set_db_connection_info_bulk_serviced_written_once(self):
+        self.patch_object(provides.hookenv, "atexit")
+        self.fake_relation.to_publish_raw = {}
+        self.fake_unit.received = {
+            "a_username": "a", "b_username": "b", "c_username": "c"}
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                prefix: {"password": "pw"} for prefix in "abc"}},
+            self.ep.ingress_address)
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "pw",
+            prefix="a")
+        self.assertEqual(self.ep.pending_requests(), ())
+        self.assertNotIn("ep.serviced", self.kv_data)
+        self.atexit.assert_called_once_with(self.ep._flush_serviced)
+        self.ep._flush_serviced()
+        self.assertEqual(
+            sorted(self.kv_data["ep.serviced"][self.fake_relation_id]),
+            ["a", "b", "c"])
+        self.kv.return_value.set.reset_mock()
+        self.ep._flush_serviced()
+        self.assertFalse(self.kv.return_value.set.called)
+
+    def test_pending_requests_batch(self):
+        self.patch_object(provides.reactive, "toggle_flag")
+        self.fake_unit.received = {
+            "username": "user",
+            "a_username": "a",
+            "b_username": "b"}
+        batch = self.ep.pending_requests_batch(2)
+        self.assertEqual([r.prefix for r in batch], [None, "a"])
+        self.assertEqual(
+            self.kv_data["ep.cursor"],
+            (self.fake_relation_id, self.fake_unit.unit_name, "a"))
+        self.toggle_flag.assert_called_once_with("ep.pending", True)
+        # Nothing was serviced, the next batch resumes after the cursor
+        self.toggle_flag.reset_mock()
+        batch = self.ep.pending_requests_batch(2)
+        self.assertEqual([r.prefix for r in batch], ["b", None])
+        self.toggle_flag.assert_called_once_with("ep.pending", True)
+        self.toggle_flag.reset_mock()
+        batch = self.ep.pending_requests_batch(5)
+        self.assertEqual([r.prefix for r in batch], ["a", "b", None])
+        self.toggle_flag.assert_called_once_with("ep.pending", False)
+
+    def next_hook(self, hook_name, relation_id=None, unit_name=None):
+        """Return the endpoint as built by the framework in another hook."""
+        self.hook_name.return_value = hook_name
+        self.relation_id.return_value = relation_id
+        self.remote_unit.return_value = unit_name
+        ep = provides.MySQLSharedProvides(
+            self.ep_name, self.ep.relation_ids())
+        ep.ingress_address = self.ep.ingress_address
+        for i, relation in enumerate(self.ep.relations):
+            ep.relations[i] = relation
+        return ep
+
+    def test_requests_index_changed_unit(self):
+        self.ep.requests_index()
+        self.fake_unit.received = {"username": "user"}
+        # Not a hook for this endpoint, nothing is re-read
+        ep = self.next_hook("update-status")
+        self.assertFalse(ep.available())
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertTrue(ep.available())
+        self.assertEqual(
+            self.kv_data["ep.requests-index"],
+            {self.fake_relation_id: {
+                self.fake_unit.unit_name: {"": {"username": "user"}}}})
+
+    def test_requests_before_handlers(self):
+        self.fake_unit.received = {"username": "user"}
+        self.ep.requests_index()
+        self.fake_unit.received = {
+            "username": "user", "nova_username": "nova"}
+        # Read by a charm handler before the changed handler of the
+        # interface ran
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertEqual(
+            [r.prefix for r in ep.requests()], [None, "nova"])
+        self.assertEqual(
+            [r.prefix for r in ep.pending_requests()], [None, "nova"])
+
+    def test_requests_index_unchanged_unit(self):
+        self.fake_unit.received = {"username": "user"}
+        self.ep.requests_index()
+        self.kv.return_value.set.reset_mock()
+        # Data other than the requests changed, nothing is written back
+        self.fake_unit.received["private-address"] = "10.0.0.1"
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertEqual(len(ep.requests()), 1)
+        self.assertFalse(self.kv.return_value.set.called)
+
+    def test_requests_index_departed_unit(self):
+        self.fake_unit.received = {"username": "user"}
+        self.ep.requests_index()
+        self.fake_relation.joined_units = []
+        ep = self.next_hook(
+            "ep-relation-departed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertFalse(ep.available())
+        self.assertEqual(self.kv_data["ep.requests-index"], {})
+        self.assertEqual(self.kv_data["ep.protocol-versions"], {})
+
+    def test_requests_index_departed_unit_later_hook(self):
+        self.fake_unit.received = {"username": "user"}
+        self.ep.requests_index()
+        # The index was not read in the departed hook
+        self.fake_relation.joined_units = []
+        ep = self.next_hook("update-status")
+        self.assertFalse(ep.available())
+        self.assertEqual(self.kv_data["ep.requests-index"], {})
+
+    def test_requests_index_broken_relation(self):
+        self.patch_object(provides.hookenv, "atexit")
+        self.fake_unit.received = {"username": "user"}
+        self.ep.requests_index()
+        self.kv_data["ep.serviced"] = {self.fake_relation_id: {"": "f"}}
+        ep = self.next_hook("ep-relation-broken", "ep:20")
+        self.assertTrue(ep.available())
+        self.ep.relations.pop(0)
+        ep = self.next_hook("ep-relation-broken", self.fake_relation_id)
+        self.assertFalse(ep.available())
+        self.assertEqual(self.kv_data["ep.protocol-versions"], {})
+        self.atexit.assert_called_once_with(ep._flush_serviced)
+        ep._flush_serviced()
+        self.assertEqual(self.kv_data["ep.serviced"], {})
+
     def test_set_db_connection_info_no_prefix(self):
         _pw = "fakepassword"
         _port = 3306
@@ -198,3 +442,375 @@ class TestMySQLSharedProvides(test_utils.PatchHelper):
             mock.call("{}_password".format(_p), _pw),
             mock.call("{}_allowed_units".format(_p), self.fake_unit.unit_name)]
         self.fake_relation.to_publish_raw.__setitem__.assert_has_calls(_calls)
+
+    def test_set_db_connection_info_bulk(self):
+        _pw = "fakepassword"
+        _pw2 = "otherpassword"
+        _port = 3306
+        other_relation = mock.MagicMock()
+        other_relation.relation_id = "shared-db:20"
+        self.ep.relations.append(other_relation)
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                None: {"password": _pw,
+                       "allowed_units": self.fake_unit.unit_name},
+                "prefix": {"password": _pw2,
+                           "allowed_units": self.fake_unit.unit_name}}},
+            self.ep.ingress_address)
+        _calls = [
+            mock.call("db_host", self.ep.ingress_address),
+            mock.call("db_port", _port),
+            mock.call("password", _pw),
+            mock.call("allowed_units", self.fake_unit.unit_name),
+            mock.call("prefix_password", _pw2),
+            mock.call("prefix_allowed_units", self.fake_unit.unit_name)]
+        self.fake_relation.to_publish_raw.__setitem__.assert_has_calls(_calls)
+        # Shared keys are only written once per relation
+        self.assertEqual(
+            self.fake_relation.to_publish_raw.__setitem__.call_count, 6)
+        other_relation.to_publish_raw.__setitem__.assert_not_called()
+
+    def test_set_ingress_address_unchanged(self):
+        self.fake_relation.to_publish_raw = {
+            "ingress-address": self.ep.ingress_address,
+            "private-address": "10.0.0.1"}
+        self.assertEqual(self.ep.set_ingress_address(), 1)
+        self.assertEqual(
+            self.fake_relation.to_publish_raw["private-address"],
+            self.ep.ingress_address)
+        self.assertEqual(self.ep.set_ingress_address(), 0)
+
+    def test_set_ingress_address_new_relations_only(self):
+        self.ep.set_ingress_address()
+        self.assertEqual(
+            self.kv_data["ep.published-address"],
+            {self.fake_relation_id: self.ep.ingress_address})
+        new_relation = mock.MagicMock()
+        new_relation.relation_id = "shared-db:20"
+        new_relation.to_publish_raw = {}
+        self.ep.relations.append(new_relation)
+        self.fake_relation.reset_mock()
+        self.assertEqual(self.ep.set_ingress_address(), 2)
+        # The existing relation's data is not touched at all
+        self.assertEqual(self.fake_relation.mock_calls, [])
+        self.assertEqual(
+            new_relation.to_publish_raw,
+            {"ingress-address": self.ep.ingress_address,
+             "private-address": self.ep.ingress_address})
+        # A new address is published everywhere, broken relations are
+        # forgotten
+        self.ep.relations.pop(0)
+        self.ep.ingress_address = "10.10.10.11"
+        self.assertEqual(self.ep.set_ingress_address(), 2)
+        self.assertEqual(
+            self.kv_data["ep.published-address"],
+            {"shared-db:20": "10.10.10.11"})
+
+    def test_set_db_connection_info_unchanged(self):
+        _pw = "fakepassword"
+        # Data read back from the relation is always a string
+        self.fake_relation.to_publish_raw = {
+            "db_host": self.ep.ingress_address,
+            "db_port": "3306",
+            "password": _pw}
+        self.assertEqual(
+            self.ep.set_db_connection_info(
+                self.fake_relation_id,
+                self.ep.ingress_address,
+                _pw,
+                allowed_units=self.fake_unit.unit_name),
+            1)
+        self.assertEqual(
+            self.fake_relation.to_publish_raw["allowed_units"],
+            self.fake_unit.unit_name)
+        self.assertEqual(
+            self.ep.set_db_connection_info(
+                self.fake_relation_id,
+                self.ep.ingress_address,
+                _pw,
+                allowed_units=self.fake_unit.unit_name),
+            0)
+
+    def test_prefetch_received(self):
+        units = []
+        received = []
+        for index in range(3):
+            unit = mock.MagicMock()
+            received.append(mock.PropertyMock(
+                return_value={"username": "user{}".format(index)}))
+            type(unit).received = received[-1]
+            units.append(unit)
+        self.fake_relation.joined_units = units
+        self.assertEqual(self.ep.prefetch_received(), 0)
+        self.assertEqual(self.ep.prefetch_received(max_workers=2), 3)
+        for prop in received:
+            prop.assert_called_once_with()
+
+    def test_prefetch_received_env(self):
+        self.patch_object(provides.os, "environ",
+                          new={provides.PREFETCH_WORKERS_ENV_VAR: "4"})
+        self.assertEqual(self.ep.prefetch_received(), 1)
+        provides.os.environ[provides.PREFETCH_WORKERS_ENV_VAR] = "many"
+        self.patch_object(provides.hookenv, "log")
+        self.assertEqual(self.ep.prefetch_received(), 0)
+        self.assertTrue(self.log.called)
+
+    def test_register_triggers_prefetch(self):
+        self.ep.prefetch_received = mock.MagicMock()
+        self.ep.register_triggers()
+        self.ep.prefetch_received.assert_not_called()
+        self.hook_name.return_value = "other-relation-changed"
+        self.ep.register_triggers()
+        self.ep.prefetch_received.assert_not_called()
+        self.hook_name.return_value = "ep-relation-changed"
+        self.ep.register_triggers()
+        self.ep.prefetch_received.assert_called_once_with()
+
+    def test_startup_prefetch_before_manage_flags(self):
+        # The framework reads the data of every joined unit in _manage_flags
+        endpoints = provides.reactive.endpoints
+        calls = []
+        self.hook_name.return_value = "ep-relation-changed"
+        self.patch_object(
+            endpoints.hookenv, "relation_types", return_value=["ep"])
+        self.patch_object(
+            endpoints.hookenv, "relation_ids", return_value=["ep:19"])
+        self.patch_object(
+            endpoints, "relation_factory",
+            return_value=provides.MySQLSharedProvides)
+        self.patch_object(endpoints.Endpoint, "_endpoints", new={})
+        self.patch_object(
+            provides.MySQLSharedProvides, "prefetch_received",
+            side_effect=lambda: calls.append("prefetch_received"))
+        self.patch_object(provides.MySQLSharedProvides, "_manage_departed")
+        self.patch_object(
+            provides.MySQLSharedProvides, "_manage_flags",
+            side_effect=lambda: calls.append("_manage_flags"))
+        provides.MySQLSharedProvides._startup()
+        self.assertEqual(calls, ["prefetch_received", "_manage_flags"])
+
+    def test_requests_index_prefetch(self):
+        self.ep.prefetch_received = mock.MagicMock()
+        self.ep.requests_index()
+        self.ep.prefetch_received.assert_called_once_with()
+        # Not needed once the index exists
+        self.ep._requests_index = None
+        self.ep.requests_index()
+        self.ep.prefetch_received.assert_called_once_with()
+
+    def test_protocol_version(self):
+        self.assertEqual(self.ep.protocol_version(self.fake_relation_id), 1)
+        self.ep._requests_index = None
+        self.ep._protocol_versions = None
+        self.kv_data.clear()
+        self.fake_unit.received = {"username": "user", "protocol-version": 2}
+        self.assertEqual(self.ep.protocol_version(self.fake_relation_id), 2)
+        self.assertEqual(
+            self.kv_data["ep.protocol-versions"],
+            {self.fake_relation_id: {self.fake_unit.unit_name: 2}})
+        # A legacy unit requesting a database on the relation
+        legacy_unit = mock.MagicMock()
+        legacy_unit.unit_name = "legacy/0"
+        legacy_unit.received = {"nova_username": "nova"}
+        self.fake_relation.joined_units.append(legacy_unit)
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id, "legacy/0")
+        self.assertEqual(ep.protocol_version(self.fake_relation_id), 1)
+        self.assertEqual(
+            self.kv_data["ep.protocol-versions"],
+            {self.fake_relation_id: {self.fake_unit.unit_name: 2,
+                                     "legacy/0": 1}})
+
+    def test_set_db_connection_info_v2(self):
+        self.fake_relation.to_publish_raw = {"nova_password": "old"}
+        self.fake_unit.received = {
+            "nova_username": "nova", "protocol-version": "2"}
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova")
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "5678",
+            allowed_units=self.fake_unit.unit_name)
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(data["protocol-version"], 2)
+        self.assertIsNone(data["nova_password"])
+        self.assertNotIn("password", data)
+        self.assertEqual(
+            json.loads(data["credentials"]),
+            {"": {"password": "5678",
+                  "allowed_units": self.fake_unit.unit_name},
+             "nova": {"password": "1234",
+                      "allowed_units": self.fake_unit.unit_name}})
+        # Back to raw keys for a legacy unit
+        self.ep._requests_index = None
+        self.ep._protocol_versions = None
+        self.kv_data.clear()
+        self.fake_unit.received = {"nova_username": "nova"}
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova")
+        self.assertEqual(data["nova_password"], "1234")
+        self.assertIsNone(data["protocol-version"])
+        self.assertEqual(
+            json.loads(data["credentials"]),
+            {"": {"password": "5678",
+                  "allowed_units": self.fake_unit.unit_name}})
+
+    def test_set_db_connection_info_v2_downgrade(self):
+        self.fake_relation.to_publish_raw = {}
+        self.fake_unit.received = {
+            "username": "user", "nova_username": "nova",
+            "protocol-version": "2"}
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                None: {"password": "1234"}, "nova": {"password": "5678"}}},
+            self.ep.ingress_address)
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(data["protocol-version"], 2)
+        # A legacy unit took over the requests of the relation
+        self.fake_unit.received = {
+            "username": "user", "nova_username": "nova"}
+        ep = self.next_hook(
+            "ep-relation-changed", self.fake_relation_id,
+            self.fake_unit.unit_name)
+        self.assertEqual(ep.protocol_version(self.fake_relation_id), 1)
+        ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                None: {"password": "1234"}, "nova": {"password": "5678"}}},
+            ep.ingress_address)
+        self.assertIsNone(data["protocol-version"])
+        self.assertIsNone(data["credentials"])
+        self.assertEqual(data["password"], "1234")
+        self.assertEqual(data["nova_password"], "5678")
+
+    def test_set_db_connection_info_read_replicas(self):
+        self.fake_relation.to_publish_raw = {}
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova",
+            db_ro_hosts=["10.0.0.11", "10.0.0.12"],
+            prefix_db_ro_hosts="10.0.0.13")
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(data["db_ro_hosts"], "10.0.0.11 10.0.0.12")
+        self.assertEqual(data["nova_db_ro_hosts"], "10.0.0.13")
+        # The replicas of the relation are kept when not given
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova")
+        self.assertEqual(data["db_ro_hosts"], "10.0.0.11 10.0.0.12")
+        self.assertIsNone(data["nova_db_ro_hosts"])
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {"nova": {"password": "1234"}}},
+            self.ep.ingress_address)
+        self.assertEqual(data["db_ro_hosts"], "10.0.0.11 10.0.0.12")
+        # Withdrawn replicas are unset
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, self.ep.ingress_address, "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova",
+            db_ro_hosts=None)
+        self.assertIsNone(data["db_ro_hosts"])
+        # Published in the credentials with version 2
+        self.fake_unit.received = {
+            "nova_username": "nova", "protocol-version": "2"}
+        self.ep._requests_index = None
+        self.ep._protocol_versions = None
+        self.kv_data.clear()
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                "nova": {"password": "1234",
+                         "allowed_units": self.fake_unit.unit_name,
+                         "db_ro_hosts": ["10.0.0.13"]}}},
+            self.ep.ingress_address, db_ro_hosts=["10.0.0.11"])
+        self.assertEqual(data["db_ro_hosts"], "10.0.0.11")
+        self.assertEqual(
+            json.loads(data["credentials"])["nova"]["db_ro_hosts"],
+            "10.0.0.13")
+
+    def test_set_db_connection_info_db_hosts(self):
+        self.fake_relation.to_publish_raw = {}
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, "10.0.0.10", "1234",
+            allowed_units=self.fake_unit.unit_name,
+            db_hosts=["10.0.0.10", ("10.0.0.11", 2), ("10.0.0.12", 0)])
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(
+            json.loads(data["db_hosts"]),
+            [{"host": "10.0.0.10", "weight": 1},
+             {"host": "10.0.0.11", "weight": 2},
+             {"host": "10.0.0.12", "weight": 0}])
+        # Kept when not given, withdrawn when None
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, "10.0.0.10", "1234",
+            allowed_units=self.fake_unit.unit_name)
+        self.assertEqual(len(json.loads(data["db_hosts"])), 3)
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, "10.0.0.10", "1234",
+            allowed_units=self.fake_unit.unit_name, db_hosts=None)
+        self.assertIsNone(data["db_hosts"])
+        with self.assertRaises(ValueError):
+            provides.format_endpoints([("10.0.0.10", -1)])
+
+    def test_set_db_connection_info_prefix_overrides(self):
+        self.fake_relation.to_publish_raw = {}
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, "10.0.0.10", "1234",
+            allowed_units=self.fake_unit.unit_name, prefix="nova_cell1",
+            prefix_db_host="10.0.1.10", prefix_db_port=3307)
+        self.ep.set_db_connection_info(
+            self.fake_relation_id, "10.0.0.10", "5678",
+            allowed_units=self.fake_unit.unit_name,
+            prefix_db_host="10.0.1.10")
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(data["db_host"], "10.0.0.10")
+        self.assertEqual(data["nova_cell1_db_host"], "10.0.1.10")
+        self.assertEqual(data["nova_cell1_db_port"], 3307)
+        # Published in the credentials with version 2
+        self.fake_unit.received = {
+            "nova_cell1_username": "nova", "protocol-version": "2"}
+        self.ep._requests_index = None
+        self.ep._protocol_versions = None
+        self.kv_data.clear()
+        self.ep.set_db_connection_info_bulk(
+            {self.fake_relation_id: {
+                "nova_cell1": {"password": "1234",
+                               "allowed_units": self.fake_unit.unit_name,
+                               "db_host": "10.0.1.10"}}},
+            "10.0.0.10")
+        self.assertIsNone(data["nova_cell1_db_host"])
+        self.assertIsNone(data["nova_cell1_db_port"])
+        self.assertEqual(
+            json.loads(data["credentials"])["nova_cell1"],
+            {"password": "1234",
+             "allowed_units": self.fake_unit.unit_name,
+             "db_host": "10.0.1.10"})
+
+    def test_requested_connections(self):
+        other_unit = mock.MagicMock()
+        other_unit.unit_name = "myunit/5"
+        other_unit.received = {
+            "nova_username": "nova", "nova_connections": "40",
+            "username": "user", "connections": "nope"}
+        self.fake_relation.joined_units.append(other_unit)
+        self.fake_unit.received = {
+            "nova_username": "nova", "nova_connections": 60,
+            "username": "user"}
+        self.assertEqual(
+            self.ep.requested_connections(),
+            {self.fake_relation_id: {"nova": 100}})
+        self.assertEqual(
+            self.kv_data["ep.requests-index"][self.fake_relation_id][
+                "myunit/5"]["nova"]["connections"], "40")
+
+    def test_set_granted_connections(self):
+        self.fake_relation.to_publish_raw = {}
+        self.assertEqual(
+            self.ep.set_granted_connections(
+                self.fake_relation_id, {"nova": 50, None: "20"}), 1)
+        data = self.fake_relation.to_publish_raw
+        self.assertEqual(
+            json.loads(data["granted-connections"]), {"": 20, "nova": 50})
+        self.assertEqual(
+            self.ep.set_granted_connections(
+                self.fake_relation_id, {None: 20, "nova": 50}), 0)
+        self.ep.set_granted_connections(self.fake_relation_id, {})
+        self.assertIsNone(data["granted-connections"])
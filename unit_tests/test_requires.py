@@ -10,237 +10,742 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-import unittest
+import base64
+import charms_openstack.test_utils as test_utils
+import collections
+import json
+import os
+import tempfile
 from unittest import mock
-
+import common
 import requires
 
 
-_hook_args = {}
-
-
-def mock_hook(*args, **kwargs):
-
-    def inner(f):
-        # remember what we were passed.  Note that we can't actually determine
-        # the class we're attached to, as the decorator only gets the function.
-        _hook_args[f.__name__] = dict(args=args, kwargs=kwargs)
-        return f
-    return inner
-
+class TestRegisteredHooks(test_utils.TestRegisteredHooks):
 
-class TestMySQLSharedRequires(unittest.TestCase):
+    def test_hooks(self):
+        defaults = []
+        hook_set = {
+            "when": {
+                "joined": (
+                    "endpoint.{endpoint_name}.joined",),
+                "changed": (
+                    "endpoint.{endpoint_name}.changed",),
+                "departed": ("endpoint.{endpoint_name}.departed",),
+            },
+        }
+        # test that the hooks were registered
+        self.registered_hooks_test_helper(requires, hook_set, defaults)
 
-    @classmethod
-    def setUpClass(cls):
-        cls._patched_hook = mock.patch('charms.reactive.hook', mock_hook)
-        cls._patched_hook_started = cls._patched_hook.start()
-        # force requires to rerun the mock_hook decorator:
-        # try except is Python2/Python3 compatibility as Python3 has moved
-        # reload to importlib.
-        try:
-            reload(requires)
-        except NameError:
-            import importlib
-            importlib.reload(requires)
 
-    @classmethod
-    def tearDownClass(cls):
-        cls._patched_hook.stop()
-        cls._patched_hook_started = None
-        cls._patched_hook = None
-        # and fix any breakage we did to the module
-        try:
-            reload(requires)
-        except NameError:
-            import importlib
-            importlib.reload(requires)
+class TestMySQLSharedRequires(test_utils.PatchHelper):
 
     def setUp(self):
+        super().setUp()
         self._patches = {}
         self._patches_start = {}
+        self.patch_object(requires.reactive, "clear_flag")
+        self.patch_object(requires.reactive, "set_flag")
+        self.patch_object(requires.reactive, "get_flags")
+        self.get_flags.return_value = []
+        self.patch_object(requires.reactive, "is_flag_set")
+        self.is_flag_set.return_value = False
+        self.patch_object(requires.hookenv, "log")
+        self.patch_object(requires.hookenv, "local_unit")
+        self.local_unit.return_value = "unit/1"
 
-        self._rel_ids = ["mysql-shared:3"]
         self._remote_data = {}
-        self._local_data = {}
-
-        self._conversation = mock.MagicMock()
-        self._conversation.relation_ids = self._rel_ids
-        self._conversation.scope = requires.scopes.GLOBAL
-        self._conversation.get_remote.side_effect = self.get_fake_remote_data
-        self._conversation.get_local.side_effect = self.get_fake_local_data
-
-        # The Relation object
-        self.mysql_shared = requires.MySQLSharedRequires(
-            'mysql-shared', [self._conversation])
-        self.patch_mysql_shared('conversations', [self._conversation])
-        self.patch_mysql_shared('set_remote')
-        self.patch_mysql_shared('set_local')
-        self.patch_mysql_shared('set_state')
-        self.patch_mysql_shared('remove_state')
-        self.patch_mysql_shared('db_host', "10.5.0.21")
-        self.patch_mysql_shared('wait_timeout', 90)
+
+        self.fake_relation_id = "mysql-shared:3"
+        self.fake_relation = mock.MagicMock()
+        self.fake_relation.relation_id = self.fake_relation_id
+        self.fake_relation.to_publish_raw = {}
+
+        self.fake_unit = mock.MagicMock()
+        self.fake_unit.unit_name = "mysql/0"
+        self.fake_unit.relation = self.fake_relation
+        self.fake_unit.received_raw = self._remote_data
+        self.fake_relation.units = [self.fake_unit]
+        self.fake_relation.joined_units = [self.fake_unit]
+
+        self.ep_name = "mysql-shared"
+        self.ep = requires.MySQLSharedRequires(
+            self.ep_name, [self.fake_relation_id])
+        self.ep.relations[0] = self.fake_relation
+        self.kv_data = {}
+        self.patch_object(requires.unitdata, "kv")
+        self.kv.return_value.get.side_effect = self.kv_data.get
+        self.kv.return_value.set.side_effect = self.kv_data.__setitem__
+        self.kv.return_value.update.side_effect = (
+            lambda data, prefix="": self.kv_data.update(
+                {prefix + key: value for key, value in data.items()}))
+        self.patch_object(requires.hookenv, "hook_name")
+        self.hook_name.return_value = "update-status"
 
     def tearDown(self):
-        self.mysql_shared = None
+        self.ep = None
         for k, v in self._patches.items():
             v.stop()
             setattr(self, k, None)
         self._patches = None
         self._patches_start = None
 
-    def patch_mysql_shared(self, attr, return_value=None):
-        mocked = mock.patch.object(self.mysql_shared, attr)
-        self._patches[attr] = mocked
-        started = mocked.start()
-        started.return_value = return_value
-        self._patches_start[attr] = started
-        setattr(self, attr, started)
-
-    def get_fake_remote_data(self, key, default=None):
-        return self._remote_data.get(key) or default
-
-    def get_fake_local_data(self, key, default=None):
-        return self._local_data.get(key) or default
-
-    def test_registered_hooks(self):
-        # test that the hooks actually registered the relation expressions that
-        # are meaningful for this interface: this is to handle regressions.
-        # The keys are the function names that the hook attaches to.
-        hook_patterns = {
-            'joined': ('{requires:mysql-shared}-relation-joined',),
-            'changed': ('{requires:mysql-shared}-relation-changed',),
-            'departed': (
-                '{requires:mysql-shared}-relation-{broken,departed}',)}
-        for k, v in _hook_args.items():
-            self.assertEqual(hook_patterns[k], v['args'])
-
-    def test_changed_available(self):
-        self.patch_mysql_shared('unit_allowed_all_dbs', True)
-        self.patch_mysql_shared('base_data_complete', True)
-        self.patch_mysql_shared('access_network_data_complete', True)
-        self.patch_mysql_shared('ssl_data_complete', True)
-        _calls = [
-            mock.call("{relation_name}.available"),
-            mock.call("{relation_name}.available.access_network"),
-            mock.call("{relation_name}.available.ssl")]
-        self.mysql_shared.changed()
-        self.set_state.assert_has_calls(_calls)
-
-    def test_changed_not_available(self):
-        self.patch_mysql_shared('base_data_complete', False)
-        self.patch_mysql_shared('access_network_data_complete', False)
-        self.patch_mysql_shared('ssl_data_complete', False)
-        self.mysql_shared.changed()
-        self.set_state.assert_not_called()
+    def set_fake_local_state(self, prefixes=None, databases=None):
+        self.kv_data[self.local_state_key] = {
+            "prefixes": prefixes or [],
+            "databases": databases or {}}
+        # Simulate a new hook so the local state is loaded again
+        self.ep._local_state = None
+
+    @property
+    def protocol_version(self):
+        return {common.PROTOCOL_VERSION_KEY: common.PROTOCOL_VERSION}
+
+    @property
+    def local_state_key(self):
+        return "reactive.conversations.{}.global.local-data.state".format(
+            self.ep_name)
+
+    def set_fake_remote_data(self, data):
+        self._remote_data = data
+        self.fake_unit.received_raw = data
+        # Simulate a new hook so the remote data is loaded again
+        self.ep._remote_snapshot = None
 
     def test_joined(self):
-        self.mysql_shared.joined()
-        self.set_state.assert_called_once_with('{relation_name}.connected')
+        self.ep.joined()
+        self.set_flag.assert_called_once_with(
+            "{}.connected".format(self.ep_name))
+
+    def test_update_flags_available(self):
+        self.patch_object(self.ep, "unit_allowed_all_dbs", return_value=True)
+        self.patch_object(self.ep, "base_data_complete", return_value=True)
+        self.patch_object(
+            self.ep, "access_network_data_complete", return_value=True)
+        self.patch_object(self.ep, "ssl_data_complete", return_value=True)
+        _calls = [
+            mock.call("{}.available".format(self.ep_name)),
+            mock.call("{}.available.access_network".format(self.ep_name)),
+            mock.call("{}.available.ssl".format(self.ep_name))]
+        self.ep.update_flags()
+        self.set_flag.assert_has_calls(_calls)
+
+    def test_update_flags_not_available(self):
+        self.patch_object(self.ep, "base_data_complete", return_value=False)
+        self.patch_object(
+            self.ep, "access_network_data_complete", return_value=False)
+        self.patch_object(self.ep, "ssl_data_complete", return_value=False)
+        self.ep.update_flags()
+        self.set_flag.assert_not_called()
+
+    def test_update_flags_series_upgrading(self):
+        self.set_fake_remote_data({"cluster-series-upgrading": "True"})
+        self.patch_object(self.ep, "base_data_complete", return_value=True)
+        self.ep.update_flags()
+        self.set_flag.assert_called_once_with(
+            "{}.series-upgrading".format(self.ep_name))
+        _calls = [
+            mock.call("{}.available".format(self.ep_name)),
+            mock.call("{}.available.access_network".format(self.ep_name)),
+            mock.call("{}.available.ssl".format(self.ep_name)),
+            mock.call("{}.available.read_replicas".format(self.ep_name))]
+        self.clear_flag.assert_has_calls(_calls)
+
+    def test_update_flags_series_upgrade_unset(self):
+        # The framework raises no changed flag for the removed key
+        self.patch_object(self.ep, "unit_allowed_all_dbs", return_value=True)
+        self.patch_object(self.ep, "base_data_complete", return_value=True)
+        self.patch_object(self.ep, "ssl_data_complete", return_value=True)
+        self.is_flag_set.return_value = True
+        self.ep.update_flags(set())
+        self.clear_flag.assert_any_call(
+            "{}.series-upgrading".format(self.ep_name))
+        self.set_flag.assert_has_calls([
+            mock.call("{}.available".format(self.ep_name)),
+            mock.call("{}.available.ssl".format(self.ep_name))])
+
+    def test_update_flags_changed_keys(self):
+        self.patch_object(self.ep, "unit_allowed_all_dbs", return_value=True)
+        self.patch_object(self.ep, "base_data_complete", return_value=True)
+        self.patch_object(
+            self.ep, "access_network_data_complete", return_value=True)
+        self.patch_object(self.ep, "ssl_data_complete", return_value=True)
+        self.ep.update_flags({"ssl_ca"})
+        self.set_flag.assert_called_once_with(
+            "{}.available.ssl".format(self.ep_name))
+        self.base_data_complete.assert_not_called()
+        self.set_flag.reset_mock()
+        self.ep.update_flags({"nova_password"})
+        self.set_flag.assert_called_once_with(
+            "{}.available".format(self.ep_name))
+        self.set_flag.reset_mock()
+        self.ep.update_flags(set())
+        self.set_flag.assert_not_called()
+        self.ep.update_flags({"cluster-series-upgrading"})
+        self.assertEqual(self.set_flag.call_count, 3)
+
+    def test_changed(self):
+        self.patch_object(self.ep, "update_flags")
+        self.get_flags.return_value = [
+            "endpoint.{}.changed".format(self.ep_name),
+            "endpoint.{}.changed.db_host".format(self.ep_name),
+            "endpoint.{}.changed.ssl_ca".format(self.ep_name),
+            "endpoint.other.changed.password",
+            "{}.connected".format(self.ep_name)]
+        self.ep.changed()
+        self.update_flags.assert_called_once_with({"db_host", "ssl_ca"})
+        _calls = [
+            mock.call("endpoint.{}.changed.db_host".format(self.ep_name)),
+            mock.call("endpoint.{}.changed.ssl_ca".format(self.ep_name)),
+            mock.call("endpoint.{}.changed".format(self.ep_name))]
+        self.clear_flag.assert_has_calls(_calls, any_order=True)
+        self.assertEqual(self.clear_flag.call_count, 3)
 
     def test_departed(self):
-        self.mysql_shared.departed()
+        self.patch_object(self.ep, "update_flags")
+        self.ep.departed()
         _calls = [
-            mock.call("{relation_name}.available"),
-            mock.call("{relation_name}.available.access_network"),
-            mock.call("{relation_name}.available.ssl")]
-        self.remove_state.assert_has_calls(_calls)
+            mock.call("{}.connected".format(self.ep_name)),
+            mock.call("{}.available".format(self.ep_name)),
+            mock.call("{}.available.access_network".format(self.ep_name)),
+            mock.call("{}.available.ssl".format(self.ep_name)),
+            mock.call("endpoint.{}.departed".format(self.ep_name))]
+        self.clear_flag.assert_has_calls(_calls, any_order=True)
+        # Units remain so state is re-evaluated
+        self.set_flag.assert_called_once_with(
+            "{}.connected".format(self.ep_name))
+        self.update_flags.assert_called_once_with()
+
+    def test_departed_multiple_relations(self):
+        self.patch_object(self.ep, "update_flags")
+        other_relation = mock.MagicMock()
+        other_relation.relation_id = "mysql-shared:4"
+        other_unit = mock.MagicMock()
+        other_unit.unit_name = "mysql/0"
+        other_unit.relation = other_relation
+        other_relation.units = [other_unit]
+        self.ep.relations.append(other_relation)
+        self.ep.departed()
+        # State is re-evaluated once however many relations remain
+        self.set_flag.assert_called_once_with(
+            "{}.connected".format(self.ep_name))
+        self.update_flags.assert_called_once_with()
+
+    def test_departed_last_unit(self):
+        self.patch_object(self.ep, "update_flags")
+        self.fake_relation.units = []
+        self.ep.departed()
+        self.set_flag.assert_not_called()
+        self.update_flags.assert_not_called()
+
+    def run_departed_hook(self, remote, relation_id, unit_name):
+        """Run a departed hook through the flags managed by the framework.
+
+        :param remote: Remote data keyed by relation id and unit name, the
+                       departing unit is already gone.
+        :returns: The flags set at the end of the hook.
+        :rtype: Set[str]
+        """
+        from charms.reactive import endpoints
+        flags = {"endpoint.{}.joined".format(self.ep_name),
+                 "{}.connected".format(self.ep_name),
+                 "{}.available".format(self.ep_name)}
+
+        def toggle_flag(flag, should_set):
+            if should_set:
+                flags.add(flag)
+            else:
+                flags.discard(flag)
+
+        for mocked in (self.set_flag, self.clear_flag, self.is_flag_set,
+                       self.get_flags):
+            mocked.side_effect = None
+        self.set_flag.side_effect = flags.add
+        self.clear_flag.side_effect = flags.discard
+        self.is_flag_set.side_effect = flags.__contains__
+        self.get_flags.side_effect = lambda: sorted(flags)
+        self.patch_object(endpoints, "set_flag", name="ep_set_flag",
+                          side_effect=flags.add)
+        self.patch_object(endpoints, "clear_flag", name="ep_clear_flag",
+                          side_effect=flags.discard)
+        self.patch_object(endpoints, "toggle_flag", name="ep_toggle_flag",
+                          side_effect=toggle_flag)
+        self.patch_object(endpoints, "is_flag_set", name="ep_is_flag_set",
+                          side_effect=flags.__contains__)
+        self.patch_object(endpoints, "data_changed", return_value=False)
+        self.patch_object(endpoints.Endpoint, "_endpoints", new={})
+        self.patch_object(endpoints.hookenv, "relation_id",
+                          return_value=relation_id)
+        self.patch_object(endpoints.hookenv, "remote_unit",
+                          return_value=unit_name)
+        self.patch_object(endpoints.hookenv, "related_units",
+                          side_effect=lambda rid: list(remote[rid]))
+        # The data of the departing unit can still be read
+        self.patch_object(
+            endpoints.hookenv, "relation_get",
+            side_effect=lambda unit, rid: dict(remote[rid].get(unit, {})))
+        self.hook_name.return_value = "{}-relation-departed".format(
+            self.ep_name)
+        ep = requires.MySQLSharedRequires(self.ep_name, sorted(remote))
+        endpoints.Endpoint._endpoints[self.ep_name] = ep
+        ep.register_triggers()
+        ep._manage_departed()
+        ep._manage_flags()
+        for name in ("joined", "changed", "departed"):
+            if "endpoint.{}.{}".format(self.ep_name, name) in flags:
+                getattr(ep, name)()
+        return flags
+
+    def test_departed_last_unit_other_relation_established(self):
+        flags = self.run_departed_hook(
+            {"mysql-shared:3": {},
+             "mysql-shared:4": {"mysql/1": {"db_host": "10.5.0.21",
+                                            "password": "1234",
+                                            "allowed_units": "unit/1"}}},
+            "mysql-shared:3", "mysql/0")
+        self.assertEqual(
+            flags,
+            {"endpoint.{}.joined".format(self.ep_name),
+             "{}.connected".format(self.ep_name),
+             "{}.available".format(self.ep_name)})
+
+    def test_departed_last_unit_last_relation(self):
+        flags = self.run_departed_hook(
+            {"mysql-shared:3": {}}, "mysql-shared:3", "mysql/0")
+        self.assertEqual(flags, set())
 
     def test_base_data_complete(self):
-        self._remote_data = {"password": "1234",
-                             "allowed_units": "unit/1"}
-        assert self.mysql_shared.base_data_complete() is True
-        self.db_host.return_value = None
-        assert self.mysql_shared.base_data_complete() is False
+        self.set_fake_remote_data({"db_host": "10.5.0.21",
+                                   "password": "1234",
+                                   "allowed_units": "unit/1"})
+        assert self.ep.base_data_complete() is True
+        del self._remote_data["db_host"]
+        self.set_fake_remote_data(self._remote_data)
+        assert self.ep.base_data_complete() is False
 
     def test_base_data_complete_prefixed(self):
-        self._local_data = {"prefixes": ["myprefix"]}
-        self._remote_data = {"myprefix_password": "1234",
-                             "myprefix_allowed_units": "unit/1"}
-        assert self.mysql_shared.base_data_complete() is True
-        self.db_host.return_value = None
-        assert self.mysql_shared.base_data_complete() is False
+        self.set_fake_local_state(prefixes=["myprefix"])
+        self.set_fake_remote_data({"db_host": "10.5.0.21",
+                                   "myprefix_password": "1234",
+                                   "myprefix_allowed_units": "unit/1"})
+        assert self.ep.base_data_complete() is True
+        del self._remote_data["db_host"]
+        self.set_fake_remote_data(self._remote_data)
+        assert self.ep.base_data_complete() is False
 
     def test_shared_db_data_complete_wait_timeout(self):
-        self._local_data = {"prefixes": ["myprefix"]}
-        self._remote_data = {"myprefix_password": "1234",
-                             "myprefix_allowed_units": "unit/1"}
+        self.set_fake_local_state(prefixes=["myprefix"])
+        self.set_fake_remote_data({"db_host": "10.5.0.21",
+                                   "myprefix_password": "1234",
+                                   "myprefix_allowed_units": "unit/1"})
         # Wait timeout is an optional value and should not affect data complete
-        self.wait_timeout.return_value = None
-        assert self.mysql_shared.base_data_complete() is True
-        self.wait_timeout.return_value = 90
-        assert self.mysql_shared.base_data_complete() is True
+        assert self.ep.base_data_complete() is True
+        self._remote_data["wait_timeout"] = "90"
+        self.set_fake_remote_data(self._remote_data)
+        assert self.ep.base_data_complete() is True
 
     def test_base_data_incomplete(self):
-        assert self.mysql_shared.base_data_complete() is False
+        assert self.ep.base_data_complete() is False
 
     def test_access_network_data_incomplete(self):
-        self.patch_mysql_shared('access_network', "10.92.3.0/24")
-        assert self.mysql_shared.access_network_data_complete() is True
-        self.access_network.return_value = None
-        assert self.mysql_shared.access_network_data_complete() is False
+        self.set_fake_remote_data({"access-network": "10.92.3.0/24"})
+        assert self.ep.access_network_data_complete() is True
+        self.set_fake_remote_data({})
+        assert self.ep.access_network_data_complete() is False
 
     def test_ssl_data_incomplete(self):
-        self.patch_mysql_shared('ssl_ca', "Certificate Authority")
-        self.patch_mysql_shared('ssl_cert', "somecert")
-        self.patch_mysql_shared('ssl_key', "somekey")
-        assert self.mysql_shared.ssl_data_complete() is True
-        self.ssl_ca.return_value = None
-        assert self.mysql_shared.ssl_data_complete() is False
+        self.set_fake_remote_data({"ssl_ca": "Certificate Authority",
+                                   "ssl_cert": "somecert",
+                                   "ssl_key": "somekey"})
+        assert self.ep.ssl_data_complete() is True
+        del self._remote_data["ssl_ca"]
+        self.set_fake_remote_data(self._remote_data)
+        assert self.ep.ssl_data_complete() is False
+
+    def test_auto_accessors(self):
+        _tests = {
+            "access-network": self.ep.access_network,
+            "db_host": self.ep.db_host,
+            "db_port": self.ep.db_port,
+            "ssl_ca": self.ep.ssl_ca,
+            "ssl_cert": self.ep.ssl_cert,
+            "ssl_key": self.ep.ssl_key,
+            "cluster-series-upgrading": self.ep.cluster_series_upgrading,
+            "wait_timeout": self.ep.wait_timeout}
+        for key, test in _tests.items():
+            self.assertEqual(test(), None)
+        self.set_fake_remote_data({key: "value" for key in _tests})
+        for key, test in _tests.items():
+            self.assertEqual(test(), "value")
 
     def test_local_accessors(self):
         _prefix = "myprefix"
         _value = "value"
         _tests = {
-            "database": self.mysql_shared.database,
-            "username": self.mysql_shared.username,
-            "hostname": self.mysql_shared.hostname}
+            "database": self.ep.database,
+            "username": self.ep.username,
+            "hostname": self.ep.hostname}
         # Not set
         for key, test in _tests.items():
             self.assertEqual(test(), None)
         # Unprefixed
         for key, test in _tests.items():
-            self._local_data = {key: _value}
+            self.set_fake_local_state(databases={"": {key: _value}})
             self.assertEqual(test(), _value)
         # Prefixed
-        self._local_data = {"prefixes": [_prefix]}
         for key, test in _tests.items():
-            self._local_data["{}_{}".format(_prefix, key)] = _value
+            self.set_fake_local_state(
+                prefixes=[_prefix], databases={_prefix: {key: _value}})
             self.assertEqual(test(prefix=_prefix), _value)
 
     def test_remote_accessors(self):
         _prefix = "myprefix"
         _value = "value"
         _tests = {
-            "password": self.mysql_shared.password,
-            "allowed_units": self.mysql_shared.allowed_units}
+            "password": self.ep.password,
+            "allowed_units": self.ep.allowed_units}
         # Not set
         for key, test in _tests.items():
             self.assertEqual(test(), None)
         # Unprefixed
         for key, test in _tests.items():
-            self._remote_data = {key: _value}
+            self.set_fake_remote_data({key: _value})
             self.assertEqual(test(), _value)
         # Prefixed
-        self._local_data = {"prefixes": [_prefix]}
+        self.set_fake_local_state(prefixes=[_prefix])
         for key, test in _tests.items():
-            self._remote_data = {"{}_{}".format(_prefix, key): _value}
+            self.set_fake_remote_data({"{}_{}".format(_prefix, key): _value})
             self.assertEqual(test(prefix=_prefix), _value)
 
+    def test_remote_data(self):
+        other_unit = mock.MagicMock()
+        other_unit.unit_name = "mysql/1"
+        other_unit.relation = self.fake_relation
+        other_unit.received_raw = {"db_host": "10.0.0.11", "password": "1234"}
+        self.fake_relation.units.append(other_unit)
+        self.set_fake_remote_data({"db_host": "10.0.0.10", "password": ""})
+        self.assertEqual(
+            self.ep.remote_data(),
+            {"db_host": "10.0.0.10", "password": "1234"})
+        # Loaded once per hook
+        self.fake_unit.received_raw = {}
+        self.assertEqual(self.ep.get_remote("db_host"), "10.0.0.10")
+        self.assertEqual(self.ep.get_remote("nope", "dflt"), "dflt")
+
+    def test_remote_data_credentials(self):
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10",
+            "password": "legacy",
+            "credentials": json.dumps({
+                "": {"password": "1234", "allowed_units": "unit/1"},
+                "nova": {"password": "5678", "allowed_units": "unit/1"}})})
+        self.assertEqual(
+            self.ep.remote_data(),
+            {"db_host": "10.0.0.10",
+             "password": "1234",
+             "allowed_units": "unit/1",
+             "nova_password": "5678",
+             "nova_allowed_units": "unit/1"})
+        self.assertEqual(self.ep.password(prefix="nova"), "5678")
+        self.assertTrue(self.ep.unit_allowed_db(prefix="nova"))
+
+    def test_remote_data_invalid_credentials(self):
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10", "credentials": "{nope"})
+        self.assertEqual(self.ep.remote_data(), {"db_host": "10.0.0.10"})
+        self.assertTrue(self.log.called)
+
+    def test_update_flags_changed_credentials(self):
+        self.patch_object(self.ep, "unit_allowed_all_dbs", return_value=True)
+        self.patch_object(self.ep, "base_data_complete", return_value=True)
+        self.ep.update_flags({"credentials"})
+        self.set_flag.assert_called_once_with(
+            "{}.available".format(self.ep_name))
+
+    def test_db_host_prefix_overrides(self):
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10",
+            "db_port": "3306",
+            "db_hosts": json.dumps([{"host": "10.0.0.11"}]),
+            "credentials": json.dumps({
+                "nova_cell1": {"password": "1234", "allowed_units": "unit/1",
+                               "db_host": "10.0.1.10", "db_port": 3307}})})
+        self.assertEqual(self.ep.db_host(), "10.0.0.10")
+        self.assertEqual(self.ep.db_host(prefix="nova"), "10.0.0.10")
+        self.assertEqual(self.ep.db_host(prefix="nova_cell1"), "10.0.1.10")
+        self.assertEqual(self.ep.db_port(prefix="nova"), "3306")
+        self.assertEqual(self.ep.db_port(prefix="nova_cell1"), "3307")
+        self.assertEqual(
+            self.ep.select_db_host(prefix="nova"), "10.0.0.11")
+        self.assertEqual(
+            self.ep.select_db_host(prefix="nova_cell1"), "10.0.1.10")
+
+    def test_db_hosts(self):
+        self.assertEqual(self.ep.db_hosts(), [])
+        self.set_fake_remote_data({"db_host": "10.0.0.10"})
+        self.assertEqual(self.ep.db_hosts(), [("10.0.0.10", 1.0)])
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10",
+            "db_hosts": json.dumps([{"host": "10.0.0.11", "weight": 2},
+                                    {"host": "10.0.0.12"}])})
+        self.assertEqual(
+            self.ep.db_hosts(), [("10.0.0.11", 2.0), ("10.0.0.12", 1.0)])
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10", "db_hosts": "[{\"weight\": 1}]"})
+        self.assertEqual(self.ep.db_hosts(), [("10.0.0.10", 1.0)])
+        self.assertTrue(self.log.called)
+
+    def test_select_db_host(self):
+        self.assertIsNone(self.ep.select_db_host())
+        hosts = ["10.0.0.{}".format(i) for i in range(10, 14)]
+        records = [{"host": host, "weight": 1} for host in hosts]
+        records.append({"host": "10.0.0.14", "weight": 0})
+        self.set_fake_remote_data({
+            "db_host": "10.0.0.10", "db_hosts": json.dumps(records)})
+        units = ["keystone/{}".format(i) for i in range(400)]
+        selected = {unit: self.ep.select_db_host(unit) for unit in units}
+        # Stable, and spread over all of the endpoints but the drained one
+        self.assertEqual(
+            selected, {unit: self.ep.select_db_host(unit) for unit in units})
+        counts = collections.Counter(selected.values())
+        self.assertEqual(set(counts), set(hosts))
+        self.assertTrue(all(count > 60 for count in counts.values()))
+        self.local_unit.return_value = "keystone/7"
+        self.assertEqual(self.ep.select_db_host(), selected["keystone/7"])
+        # Removing an endpoint only moves the units that had selected it
+        self.set_fake_remote_data({
+            "db_hosts": json.dumps([{"host": host} for host in hosts[1:]])})
+        for unit in units:
+            if selected[unit] != hosts[0]:
+                self.assertEqual(self.ep.select_db_host(unit), selected[unit])
+
+    def test_db_ro_hosts(self):
+        self.assertEqual(self.ep.db_ro_hosts(), [])
+        self.set_fake_remote_data({
+            "db_ro_hosts": "10.0.0.11 10.0.0.12",
+            "credentials": json.dumps({
+                "nova": {"password": "1234", "allowed_units": "unit/1",
+                         "db_ro_hosts": "10.0.0.13"}})})
+        self.assertEqual(self.ep.db_ro_hosts(), ["10.0.0.11", "10.0.0.12"])
+        self.assertEqual(self.ep.db_ro_hosts(prefix="nova"), ["10.0.0.13"])
+        self.assertEqual(
+            self.ep.db_ro_hosts(prefix="glance"), ["10.0.0.11", "10.0.0.12"])
+
+    def test_read_replicas_data_complete(self):
+        self.set_fake_local_state(prefixes=["nova", "glance"])
+        self.set_fake_remote_data({"nova_db_ro_hosts": "10.0.0.13"})
+        assert self.ep.read_replicas_data_complete() is False
+        self.set_fake_remote_data({"nova_db_ro_hosts": "10.0.0.13",
+                                   "db_ro_hosts": "10.0.0.11"})
+        assert self.ep.read_replicas_data_complete() is True
+
+    def test_update_flags_read_replicas(self):
+        _flag = "{}.available.read_replicas".format(self.ep_name)
+        self.set_fake_remote_data({"db_ro_hosts": "10.0.0.11"})
+        self.ep.update_flags({"db_ro_hosts"})
+        self.set_flag.assert_called_once_with(_flag)
+        # The raw key is unset, which raises no changed flag for it
+        self.set_fake_remote_data({})
+        self.ep.update_flags({"db_host"})
+        self.clear_flag.assert_called_once_with(_flag)
+        self.clear_flag.reset_mock()
+        self.ep.update_flags(set())
+        self.clear_flag.assert_called_once_with(_flag)
+
+    def test_write_ssl_file(self):
+        _pem = "-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_ca", tmpdir), (None, False))
+            self.ep._ssl_files = {}
+            self.set_fake_remote_data({
+                "ssl_ca": base64.b64encode(_pem.encode()).decode(),
+                "ssl_key": _pem})
+            path, changed = self.ep.write_ssl_file("ssl_ca", tmpdir)
+            self.assertTrue(changed)
+            self.assertTrue(os.path.basename(path).startswith("ssl_ca-"))
+            with open(path) as f:
+                self.assertEqual(f.read(), _pem)
+            # Decoded and written once
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_ca", tmpdir), (path, False))
+            # Same content, either encoded or not, in a new hook
+            self.ep._ssl_files = {}
+            mtime = os.stat(path).st_mtime_ns
+            self.set_fake_remote_data({"ssl_ca": _pem, "ssl_key": _pem})
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_ca", tmpdir), (path, False))
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+            key_path, changed = self.ep.write_ssl_file("ssl_key", tmpdir)
+            self.assertTrue(changed)
+            self.assertEqual(os.stat(key_path).st_mode & 0o777, 0o600)
+            # New material
+            self.ep._ssl_files = {}
+            self.set_fake_remote_data({"ssl_ca": _pem + "\n"})
+            new_path, changed = self.ep.write_ssl_file("ssl_ca", tmpdir)
+            self.assertTrue(changed)
+            self.assertNotEqual(new_path, path)
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)),
+                sorted(os.path.basename(p)
+                       for p in (path, key_path, new_path)))
+            # Superseded material is removed in the next hook
+            self.ep._ssl_files = {}
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_ca", tmpdir), (new_path, False))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_key", tmpdir), (None, True))
+            self.assertTrue(os.path.exists(key_path))
+            self.ep._ssl_files = {}
+            self.assertEqual(
+                self.ep.write_ssl_file("ssl_key", tmpdir), (None, False))
+            self.assertEqual(
+                os.listdir(tmpdir), [os.path.basename(new_path)])
+
+    def test_decode_ssl_material(self):
+        _pem = "-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n"
+        self.assertEqual(
+            requires._decode_ssl_material(_pem), _pem.encode())
+        encoded = base64.encodebytes(_pem.encode()).decode()
+        self.assertEqual(
+            requires._decode_ssl_material(encoded), _pem.encode())
+        # Valid base64 that does not decode to PEM is kept as given
+        self.assertEqual(requires._decode_ssl_material("abcd"), b"abcd")
+        raw = base64.b64encode(b"\x30\x82 DER").decode()
+        self.assertEqual(requires._decode_ssl_material(raw), raw.encode())
+        self.assertEqual(
+            requires._decode_ssl_material("not base64!"), b"not base64!")
+
+    def test_write_atomically_fdopen_fails(self):
+        self.patch_object(requires.os, "fdopen", side_effect=OSError("boom"))
+        self.patch_object(requires.os, "close", wraps=os.close)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaisesRegex(OSError, "boom"):
+                requires._write_atomically(
+                    os.path.join(tmpdir, "f"), b"data", 0o600)
+            self.close.assert_called_once_with(mock.ANY)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_write_atomically_keeps_original_error(self):
+        self.patch_object(requires.os, "replace", side_effect=OSError("boom"))
+        self.patch_object(
+            requires.os, "remove", side_effect=FileNotFoundError("gone"))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaisesRegex(OSError, "boom"):
+                requires._write_atomically(
+                    os.path.join(tmpdir, "f"), b"data", 0o600)
+
+    def test_set_remote(self):
+        self.ep.set_remote(database="db", username="user")
+        self.assertEqual(
+            self.fake_relation.to_publish_raw,
+            {"database": "db", "username": "user"})
+
+    def test_local_data(self):
+        _prefix = "reactive.conversations.{}.global.local-data.".format(
+            self.ep_name)
+        self.ep.set_local("prefixes", ["nova"])
+        self.ep.set_local(database="nova", username="nova")
+        self.assertEqual(
+            self.kv_data,
+            {_prefix + "prefixes": ["nova"],
+             _prefix + "database": "nova",
+             _prefix + "username": "nova"})
+        self.assertEqual(self.ep.get_local("database"), "nova")
+        self.assertEqual(self.ep.get_local("hostname", "dflt"), "dflt")
+
+    def test_local_state_legacy(self):
+        # Configuration stored one key per field by earlier versions
+        self.ep.set_local(prefixes=["nova"],
+                          database="keystone",
+                          username="keystone",
+                          hostname="10.0.0.1",
+                          nova_database="nova",
+                          nova_username="nova",
+                          nova_hostname="10.0.0.1")
+        self.assertEqual(
+            self.ep.local_state(),
+            {"prefixes": ["nova"],
+             "databases": {
+                 "": {"database": "keystone",
+                      "username": "keystone",
+                      "hostname": "10.0.0.1"},
+                 "nova": {"database": "nova",
+                          "username": "nova",
+                          "hostname": "10.0.0.1"}}})
+        self.assertEqual(self.ep.get_prefixes(), ["nova"])
+        self.assertEqual(self.ep.database(prefix="nova"), "nova")
+        self.assertNotIn(self.local_state_key, self.kv_data)
+
+    def test_local_state_written_when_dirty(self):
+        self.patch_object(self.ep, "set_remote")
+        self.ep.configure("db", "user", "host", prefix="prefix")
+        self.assertEqual(
+            self.kv_data[self.local_state_key],
+            {"prefixes": ["prefix"],
+             "databases": {"prefix": {"database": "db",
+                                      "username": "user",
+                                      "hostname": "host"}}})
+        self.assertEqual(self.kv.return_value.set.call_count, 1)
+        # Unchanged configuration is not written again
+        self.ep.configure("db", "user", "host", prefix="prefix")
+        self.ep.set_prefix("prefix")
+        self.assertEqual(self.kv.return_value.set.call_count, 1)
+
     def test_configure(self):
         _db = "db"
         _user = "user"
         _host = "host"
         _prefix = None
-        self.mysql_shared.configure(_db, _user, _host, prefix=_prefix)
+        self.patch_object(self.ep, "set_remote")
+        self.ep.configure(_db, _user, _host, prefix=_prefix)
+        self.set_remote.assert_called_once_with(
+            database=_db, username=_user, hostname=_host,
+            **self.protocol_version)
+        self.assertEqual(self.ep.database(), _db)
+        self.assertEqual(self.ep.username(), _user)
+        self.assertEqual(self.ep.hostname(), _host)
+        self.assertEqual(self.ep.get_prefixes(), None)
+
+    @mock.patch.object(requires.hookenv, "network_get_primary_address")
+    def test_configure_network_address(self, network_get_primary_address):
+        network_get_primary_address.return_value = "10.0.0.1"
+        self.patch_object(self.ep, "set_remote")
+        self.ep.configure("db", "user")
+        network_get_primary_address.assert_called_once_with(self.ep_name)
+        self.set_remote.assert_called_once_with(
+            database="db", username="user", hostname="10.0.0.1",
+            **self.protocol_version)
+        self.assertEqual(
+            self.kv_data["{}.primary-address".format(self.ep_name)],
+            "10.0.0.1")
+        # Cached between hooks
+        network_get_primary_address.return_value = "10.0.0.2"
+        self.ep.configure("db", "user")
+        network_get_primary_address.assert_called_once_with(self.ep_name)
+        # Resolved again in hooks where the address may change
+        self.hook_name.return_value = "config-changed"
+        self.set_remote.reset_mock()
+        self.ep.configure("db", "user")
+        self.set_remote.assert_called_once_with(
+            database="db", username="user", hostname="10.0.0.2",
+            **self.protocol_version)
+
+    @mock.patch.object(requires.hookenv, "unit_private_ip")
+    @mock.patch.object(requires.hookenv, "network_get_primary_address")
+    def test_configure_private_address(self, network_get_primary_address,
+                                       unit_private_ip):
+        network_get_primary_address.side_effect = NotImplementedError
+        unit_private_ip.return_value = "10.0.0.3"
+        self.patch_object(self.ep, "set_remote")
+        self.ep.configure("db", "user")
         self.set_remote.assert_called_once_with(
-            database=_db, username=_user, hostname=_host)
-        self.set_local.assert_called_once_with(
-            database=_db, username=_user, hostname=_host)
+            database="db", username="user", hostname="10.0.0.3",
+            **self.protocol_version)
 
     def test_configure_prefixed(self):
-        self.patch_mysql_shared('set_prefix')
+        self.patch_object(self.ep, "set_remote")
         _db = "db"
         _user = "user"
         _host = "host"
@@ -249,55 +754,117 @@ class TestMySQLSharedRequires(unittest.TestCase):
             "{}_database".format(_prefix): _db,
             "{}_username".format(_prefix): _user,
             "{}_hostname".format(_prefix): _host}
-        self.mysql_shared.configure(_db, _user, _host, prefix=_prefix)
+        _expected.update(self.protocol_version)
+        self.ep.configure(_db, _user, _host, prefix=_prefix)
         self.set_remote.assert_called_once_with(**_expected)
-        self.set_local.assert_called_once_with(**_expected)
-        self.set_prefix.assert_called_once()
+        self.assertEqual(self.ep.get_prefixes(), [_prefix])
+        self.assertEqual(self.ep.database(prefix=_prefix), _db)
+        self.assertEqual(self.ep.username(prefix=_prefix), _user)
+        self.assertEqual(self.ep.hostname(prefix=_prefix), _host)
+        self.assertEqual(self.ep.database(), None)
+
+    def test_configure_many(self):
+        self.patch_object(self.ep, "_primary_address", return_value="10.0.0.1")
+        self.patch_object(self.ep, "set_remote")
+        self.set_fake_local_state(prefixes=["nova"])
+        self.ep.configure_many([
+            ("nova", "nova", "nova"),
+            ("nova_api", "nova", "novaapi"),
+            ("keystone", "keystone", None)])
+        _expected = {
+            "nova_database": "nova",
+            "nova_username": "nova",
+            "nova_hostname": "10.0.0.1",
+            "novaapi_database": "nova_api",
+            "novaapi_username": "nova",
+            "novaapi_hostname": "10.0.0.1",
+            "database": "keystone",
+            "username": "keystone",
+            "hostname": "10.0.0.1"}
+        _expected.update(self.protocol_version)
+        self._primary_address.assert_called_once_with()
+        self.set_remote.assert_called_once_with(**_expected)
+        self.assertEqual(self.ep.get_prefixes(), ["nova", "novaapi"])
+        self.assertEqual(self.ep.database(prefix="novaapi"), "nova_api")
+        self.assertEqual(self.ep.database(), "keystone")
+        # All of the configuration is stored with a single write
+        self.kv.return_value.set.assert_called_once_with(
+            self.local_state_key, mock.ANY)
+
+    def test_configure_connections(self):
+        self.patch_object(self.ep, "_primary_address", return_value="10.0.0.1")
+        self.patch_object(self.ep, "set_remote")
+        self.ep.configure("nova", "nova", prefix="nova", connections=64)
+        self.assertEqual(
+            self.set_remote.call_args[1]["nova_connections"], 64)
+        self.ep.configure_many([
+            ("nova_api", "nova", "novaapi", 32),
+            ("keystone", "keystone", None)])
+        _kwargs = self.set_remote.call_args[1]
+        self.assertEqual(_kwargs["novaapi_connections"], 32)
+        self.assertNotIn("connections", _kwargs)
+
+    def test_granted_connections(self):
+        self.assertIsNone(self.ep.granted_connections())
+        self.set_fake_remote_data({
+            "granted-connections": json.dumps({"": 20, "nova": "50"})})
+        self.assertEqual(self.ep.granted_connections(), 20)
+        self.assertEqual(self.ep.granted_connections(prefix="nova"), 50)
+        self.assertIsNone(self.ep.granted_connections(prefix="glance"))
+        self.set_fake_remote_data({"granted-connections": "[20]"})
+        self.assertIsNone(self.ep.granted_connections())
+        self.assertTrue(self.log.called)
 
     def test_get_prefix(self):
         _prefix = "prefix"
-        self._local_data = {"prefixes": [_prefix]}
+        self.assertEqual(self.ep.get_prefixes(), None)
+        self.set_fake_local_state(prefixes=[_prefix])
         self.assertEqual(
-            self.mysql_shared.get_prefixes(), [_prefix])
+            self.ep.get_prefixes(), [_prefix])
 
     def test_set_prefix(self):
         # First
         _prefix = "prefix"
-        self.mysql_shared.set_prefix(_prefix)
-        self.set_local.assert_called_once_with("prefixes", [_prefix])
+        self.ep.set_prefix(_prefix)
+        self.assertEqual(
+            self.kv_data[self.local_state_key]["prefixes"], [_prefix])
         # More than one
-        self.set_local.reset_mock()
-        self._local_data = {"prefixes": [_prefix]}
         _second = "secondprefix"
-        self.mysql_shared.set_prefix(_second)
-        self.set_local.assert_called_once_with("prefixes", [_prefix, _second])
-
-    @mock.patch.object(requires.hookenv, 'log')
-    @mock.patch.object(requires.hookenv, 'local_unit')
-    def test_unit_allowed_db(self, local_unit, log):
-        self._remote_data = {'allowed_units': 'unit/1 unit/3'}
-        local_unit.return_value = 'unit/1'
-        self.assertTrue(self.mysql_shared.unit_allowed_db())
-        local_unit.return_value = 'unit/2'
-        self.assertFalse(self.mysql_shared.unit_allowed_db())
-
-    @mock.patch.object(requires.hookenv, 'log')
-    @mock.patch.object(requires.hookenv, 'local_unit')
-    def test_unit_allowed_db_prefix(self, local_unit, log):
-        self._remote_data = {'bob_allowed_units': 'unit/1 unit/3'}
-        local_unit.return_value = 'unit/1'
-        self.assertTrue(self.mysql_shared.unit_allowed_db(prefix='bob'))
-        self.assertFalse(self.mysql_shared.unit_allowed_db())
-        self.assertFalse(self.mysql_shared.unit_allowed_db(prefix='flump'))
-
-    @mock.patch.object(requires.hookenv, 'log')
-    @mock.patch.object(requires.hookenv, 'local_unit')
-    def test_unit_allowed_all_dbs(self, local_unit, log):
-        local_unit.return_value = 'unit/1'
-        self._local_data = {"prefixes": ['prefix1', 'prefix2']}
-        self._remote_data = {'prefix1_allowed_units': 'unit/1 unit/3'}
-        self.assertFalse(self.mysql_shared.unit_allowed_all_dbs())
-        self._remote_data = {
+        self.ep.set_prefix(_second)
+        self.assertEqual(
+            self.kv_data[self.local_state_key]["prefixes"],
+            [_prefix, _second])
+
+    def test_allowed_units_set(self):
+        self.set_fake_remote_data({'allowed_units': 'unit/1 unit/3'})
+        allowed = self.ep.allowed_units_set()
+        self.assertEqual(allowed, {'unit/1', 'unit/3'})
+        # The parsed set is reused while the remote value is unchanged
+        self.assertIs(self.ep.allowed_units_set(), allowed)
+        self.set_fake_remote_data({'allowed_units': 'unit/1'})
+        self.assertEqual(self.ep.allowed_units_set(), {'unit/1'})
+        self.assertEqual(self.ep.allowed_units_set(prefix='bob'), set())
+
+    def test_unit_allowed_db(self):
+        self.set_fake_remote_data({'allowed_units': 'unit/1 unit/3'})
+        self.local_unit.return_value = 'unit/1'
+        self.assertTrue(self.ep.unit_allowed_db())
+        self.local_unit.return_value = 'unit/2'
+        self.assertFalse(self.ep.unit_allowed_db())
+
+    def test_unit_allowed_db_prefix(self):
+        self.set_fake_remote_data({'bob_allowed_units': 'unit/1 unit/3'})
+        self.local_unit.return_value = 'unit/1'
+        self.assertTrue(self.ep.unit_allowed_db(prefix='bob'))
+        self.assertFalse(self.ep.unit_allowed_db())
+        self.assertFalse(self.ep.unit_allowed_db(prefix='flump'))
+
+    def test_unit_allowed_all_dbs(self):
+        self.local_unit.return_value = 'unit/1'
+        self.set_fake_local_state(prefixes=['prefix1', 'prefix2'])
+        self.set_fake_remote_data({'prefix1_allowed_units': 'unit/1 unit/3'})
+        self.assertFalse(self.ep.unit_allowed_all_dbs())
+        self.set_fake_remote_data({
             'prefix1_allowed_units': 'unit/1 unit/3',
-            'prefix2_allowed_units': 'unit/1 unit/3'}
-        self.assertTrue(self.mysql_shared.unit_allowed_all_dbs())
+            'prefix2_allowed_units': 'unit/1 unit/3'})
+        self.assertTrue(self.ep.unit_allowed_all_dbs())